@@ -1,32 +1,49 @@
 import asyncio
 import base64
+import bisect
 import datetime
-from io import BytesIO
+import hashlib
 import json
+import math
 import os
 import re
+import socket
+import sqlite3
+import threading
 import time
 import traceback
+import uuid
 import timeago
 from twikit import Client, Tweet
 import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
-import numpy as np
-import os
 import requests
 import twikit
 import twikit.media
-import builtins
-from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import aclosing, contextmanager
 import random
 
 load_dotenv()
 
 CHANNEL_ID=os.getenv("CHANNEL_ID", "")
+# JSON object of handle -> list of channel IDs, "*" for every other handle; falls back to CHANNEL_ID
+CHANNEL_ROUTES={
+    handle.lower(): [channels] if isinstance(channels, str) else channels
+    for handle, channels in json.loads(os.getenv("CHANNEL_ROUTES", "{}")).items()
+}
+assert all(
+    isinstance(channels, list) and all(isinstance(channel, str) for channel in channels)
+    for channels in CHANNEL_ROUTES.values()
+), "CHANNEL_ROUTES values must be a channel ID or a list of channel IDs."
 X_USERNAME=os.getenv("X_USERNAME", "")
 X_EMAIL=os.getenv("X_EMAIL", "")
 X_PASSWORD=os.getenv("X_PASSWORD", "")
 X_COOKIES=os.getenv("X_COOKIES", None)
+# Several comma-separated cookie sets spread the watched handles over that many accounts
+X_COOKIES_POOL=[cookies.strip() for cookies in (X_COOKIES or "").split(",") if cookies.strip()]
 X_FORCE_PUSH_AUTH=os.getenv("X_FORCE_PUSH_AUTH", None)
 WHATSAPP_BASIC_AUTH=os.getenv("WHATSAPP_BASIC_AUTH", "")
 
@@ -38,6 +55,96 @@ DATA_DIR = "./data/"
 
 WHATSAPP_URL = os.getenv("WHATSAPP_API_URL", "http://localhost:3000")
 
+# Sent/errored tweet IDs older than this are pruned on compaction (0 keeps them forever)
+DEDUP_RETENTION_DAYS = float(os.getenv("DEDUP_RETENTION_DAYS", "30"))
+# Number of journal appends between snapshot rewrites
+DEDUP_COMPACT_EVERY = int(os.getenv("DEDUP_COMPACT_EVERY", "1000"))
+
+TWITTER_EPOCH_MS = 1288834974657
+
+# Max simultaneous connections held open by the shared WhatsApp session
+WHATSAPP_POOL_LIMIT = int(os.getenv("WHATSAPP_POOL_LIMIT", "4"))
+# Seconds before a single WhatsApp request (including uploads) is abandoned
+WHATSAPP_REQUEST_TIMEOUT = float(os.getenv("WHATSAPP_REQUEST_TIMEOUT", "300"))
+WHATSAPP_CONNECT_TIMEOUT = float(os.getenv("WHATSAPP_CONNECT_TIMEOUT", "10"))
+# Ceiling on messages sent through the gateway per minute, to stay clear of WhatsApp's ban thresholds
+WHATSAPP_MAX_SENDS_PER_MINUTE = float(os.getenv("WHATSAPP_MAX_SENDS_PER_MINUTE", "20"))
+# "stream" pipes videos from X's CDN through us, "url" hands the gateway a video_url to fetch
+WHATSAPP_VIDEO_MODE = os.getenv("WHATSAPP_VIDEO_MODE", "stream")
+
+# Largest estimated video size (bitrate * duration) to download, 0 disables the cap
+VIDEO_MAX_BYTES = int(float(os.getenv("VIDEO_MAX_MB", "16")) * 1024 * 1024)
+# Largest shorter-side resolution (e.g. 720 for 1280x720) to download, 0 disables the cap
+VIDEO_MAX_RESOLUTION = int(os.getenv("VIDEO_MAX_RESOLUTION", "0"))
+
+# Handles fetched at the same time, and the ceiling on X requests started per minute
+X_FETCH_CONCURRENCY = int(os.getenv("X_FETCH_CONCURRENCY", "4"))
+X_MAX_REQUESTS_PER_MINUTE = float(os.getenv("X_MAX_REQUESTS_PER_MINUTE", "20"))
+# How long to back off after a 429 from X that doesn't say when the limit resets
+X_RATE_LIMIT_FALLBACK_SECONDS = 15 * 60
+
+# How long a resolved screen name -> user ID mapping is trusted
+USER_ID_CACHE_TTL_HOURS = float(os.getenv("USER_ID_CACHE_TTL_HOURS", "168"))
+
+# Page size bounds for a handle's timeline fetch, and how far back a burst is followed
+HANDLE_PAGE_SIZE_MIN = int(os.getenv("HANDLE_PAGE_SIZE_MIN", "5"))
+HANDLE_PAGE_SIZE_MAX = int(os.getenv("HANDLE_PAGE_SIZE_MAX", "40"))
+HANDLE_MAX_PAGES = int(os.getenv("HANDLE_MAX_PAGES", "5"))
+
+# Bounds on how often a single handle is polled, and the average polls/hour each handle may use
+X_POLL_MIN_MINUTES = float(os.getenv("X_POLL_MIN_MINUTES", "4"))
+X_POLL_MAX_MINUTES = float(os.getenv("X_POLL_MAX_MINUTES", "40"))
+X_POLL_BUDGET_PER_HANDLE = float(os.getenv("X_POLL_BUDGET_PER_HANDLE", "2.5"))
+
+# Read watched handles' tweets off the home timeline (the account must follow them) instead of one request per handle
+X_TIMELINE_MODE = os.getenv("X_TIMELINE_MODE", "0").lower() in ("1", "true", "yes")
+TIMELINE_PAGE_SIZE = int(os.getenv("TIMELINE_PAGE_SIZE", "40"))
+
+# Delivery workers draining the send queue (each channel is still sent to in order)
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "1"))
+
+# Queued tweets whose videos are downloaded ahead of their turn, and the disk/concurrency caps for it
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", "2"))
+PREFETCH_MAX_BYTES = int(float(os.getenv("PREFETCH_MAX_MB", "200")) * 1024 * 1024)
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "3"))
+
+# Downloaded videos are kept for retries, other channels and re-posts, least recently used evicted past this (0 disables)
+MEDIA_CACHE_MAX_BYTES = int(float(os.getenv("MEDIA_CACHE_MAX_MB", "500")) * 1024 * 1024)
+
+# Failed deliveries are retried after RETRY_BASE_SECONDS, doubling up to RETRY_MAX_SECONDS
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = float(os.getenv("RETRY_BASE_SECONDS", "60"))
+RETRY_MAX_SECONDS = float(os.getenv("RETRY_MAX_SECONDS", "3600"))
+RETRY_CHECK_SECONDS = 10
+
+# How long startup waits for the WARP proxy and the WhatsApp gateway to come up
+STARTUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_TIMEOUT_SECONDS", "120"))
+
+# Port serving /metrics (Prometheus text format), /healthz and /readyz (0 disables)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
+# /healthz fails once no poll round has finished for this long
+LIVENESS_MAX_ROUND_GAP_SECONDS = 3 * X_POLL_MAX_MINUTES * 60
+
+# How long a login waits for X's verification code email to show up in ImprovMX
+X_VERIFICATION_TIMEOUT_SECONDS = float(os.getenv("X_VERIFICATION_TIMEOUT_SECONDS", "300"))
+# ImprovMX is polled after this many seconds, doubling up to the max
+VERIFICATION_POLL_BASE_SECONDS = 2
+VERIFICATION_POLL_MAX_SECONDS = 30
+
+# The same text or media queued to a channel within this window isn't sent in full again (0 disables)
+CONTENT_DEDUP_WINDOW_HOURS = float(os.getenv("CONTENT_DEDUP_WINDOW_HOURS", "24"))
+# "collapse" sends a short "also posted by" note instead of the duplicate, "skip" drops it
+CONTENT_DEDUP_MODE = os.getenv("CONTENT_DEDUP_MODE", "collapse")
+# Shorter texts ("🚨", "BREAKING") are too common to count as the same story
+CONTENT_DEDUP_MIN_TEXT_LENGTH = 30
+
+# SQLite file on a volume shared by every replica, set it to run several replicas against the same handles
+COORDINATION_DB = os.getenv("COORDINATION_DB", "")
+# Must be unique per replica, a restarted replica may reuse its old ID
+REPLICA_ID = os.getenv("REPLICA_ID", f"{socket.gethostname()}-{os.getpid()}")
+# How long a replica keeps its handles without renewing before another replica may take them over
+HANDLE_LEASE_SECONDS = float(os.getenv("HANDLE_LEASE_SECONDS", "120"))
+
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
     print(f"Created {DATA_DIR}")
@@ -46,59 +153,289 @@ else:
     for file in os.listdir(DATA_DIR):
         print("->", file)
 
-print("Verifying WARP is working...")
-
 WARP_PROXY_URL = os.getenv("WARP_PROXY_URL")
 
 assert WARP_PROXY_URL, "WARP_PROXY_URL env variable must be defined."
 
-response = requests.get('https://ifconfig.me/')
-print(f"Your IP address: {response.text.strip()}")
-
-while True:
-    try:
-        response = requests.get('https://ifconfig.me/', proxies={'http': WARP_PROXY_URL, 'https': WARP_PROXY_URL})
-        print(f"Your IP through proxy: {response.text.strip()}")
-        break
-    except requests.exceptions.ConnectionError as e:
-        if "[Errno 111] Connection refused" in str(e):
-            print("WARP Proxy not yet started...")
-            time.sleep(2)
-            continue
-        else:
-            raise e
-
-print("Verifying WhatsApp is logged in...", '/app/login')
-while True:
-    try:
-        response = requests.get(f'{WHATSAPP_URL}/app/login', headers=WHATSAPP_HEADERS)
-        if response.status_code == 401:
-            raise Exception(f"WhatsApp API returned status code {response.status_code}: {response.text}")
-        
-        data = response.json()
-        
-        if data.get("code") == "SUCCESS" and data.get("results", {}).get("qr_link"):
-            raise Exception(f"Login to WhatsApp @ {data.get('results', {}).get('qr_link')}")
-        elif data.get("code") == "ALREADY_LOGGED_IN":
-            print("WhatsApp is logged in!")
-            break
-        elif data.get("code") == "SESSION_SAVED_ERROR":
-            print("WhatsApp session already saved, proceeding with the script.")
-            print("Retrying in 2 seconds...")
-            time.sleep(2)
-            continue
-        else:
-            raise Exception(f"WhatsApp API returned unexpected response: {data}")
-
-    except Exception as e:
-        print(f"WhatsApp API authentication failed.")
-        raise e
-
 if (X_USERNAME == "" or X_PASSWORD == "" or X_EMAIL == "") and not X_COOKIES:
     raise Exception("Either one of\n1. X_USERNAME, X_PASSWORD\nX_EMAIL 2. X_COOKIES.\n must be provided.")
 else:
     print("Credentials provided, proceeding with the script.")
 
+class TokenBucket:
+    """
+    Allows `rate_per_minute` requests per minute on average, with bursts of up
+    to `capacity`. `pause_until` holds every caller back until a given time,
+    e.g. the reset X sends along with a 429.
+    """
+    def __init__(self, name: str, rate_per_minute: float, capacity: float):
+        self.name = name
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.used = 0
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                paused_for = self.paused_until - time.time()
+                if paused_for > 0:
+                    await asyncio.sleep(paused_for)
+                    continue
+
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used += 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate_per_second)
+
+    def pause_until(self, timestamp: float):
+        self.paused_until = max(self.paused_until, timestamp)
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "used": self.used,
+            "tokens": round(self.tokens, 2),
+            "capacity": self.capacity,
+            "paused_for_seconds": max(0.0, round(self.paused_until - time.time(), 2)),
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        paused = f", paused for {stats['paused_for_seconds']}s" if stats["paused_for_seconds"] else ""
+        print(f"{self.name}: {stats['used']} used, {stats['tokens']}/{stats['capacity']} available{paused}.")
+
+whatsapp_sends = TokenBucket("WhatsApp sends", WHATSAPP_MAX_SENDS_PER_MINUTE, 3)
+
+class Histogram:
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.bucket_counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+class Metrics:
+    """
+    In-process counters and histograms, plus gauges read off the queues when
+    scraped, rendered in Prometheus' text format for /metrics. Also holds the
+    state /healthz and /readyz report on.
+    """
+    def __init__(self):
+        # name -> (type, help)
+        self.descriptions: dict[str, tuple[str, str]] = {}
+        self.buckets: dict[str, tuple[float, ...]] = {}
+        self.samples: dict[str, dict[tuple, float | Histogram]] = {}
+        self.collectors: dict[str, Callable[[], float]] = {}
+
+        self.ready = False
+        self.last_round_at: float | None = None
+
+    def counter(self, name: str, help_text: str):
+        self.descriptions[name] = ("counter", help_text)
+        self.samples[name] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: tuple[float, ...]):
+        self.descriptions[name] = ("histogram", help_text)
+        self.buckets[name] = buckets
+        self.samples[name] = {}
+
+    def collector(self, name: str, metric_type: str, help_text: str, collect: Callable[[], float]):
+        """
+        A metric whose value is read by calling `collect()` at scrape time.
+        """
+        self.descriptions[name] = (metric_type, help_text)
+        self.collectors[name] = collect
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.samples[name][key] = self.samples[name].get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        histogram = self.samples[name].get(key)
+        if histogram is None:
+            histogram = self.samples[name][key] = Histogram(self.buckets[name])
+
+        for i, bound in enumerate(self.buckets[name]):
+            if value <= bound:
+                histogram.bucket_counts[i] += 1
+        histogram.sum += value
+        histogram.count += 1
+
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, (metric_type, help_text) in self.descriptions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+            if name in self.collectors:
+                lines.append(f"{name} {self.collectors[name]()}")
+            elif metric_type == "counter":
+                for labels, value in self.samples[name].items():
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+            else:
+                for labels, histogram in self.samples[name].items():
+                    for bound, count in zip(self.buckets[name], histogram.bucket_counts):
+                        lines.append(f"{name}_bucket{self._format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def is_live(self) -> bool:
+        return self.last_round_at is None or time.time() - self.last_round_at <= LIVENESS_MAX_ROUND_GAP_SECONDS
+
+metrics = Metrics()
+
+REQUEST_SECONDS_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+DELIVERY_LAG_SECONDS_BUCKETS = (30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 21600, 86400)
+
+metrics.histogram("tweetky_x_request_seconds", "Duration of X timeline requests, by handle.", REQUEST_SECONDS_BUCKETS)
+metrics.counter("tweetky_x_fetches_total", "Handle fetches, by handle and result (ok, rate_limited, error).")
+metrics.counter("tweetky_x_errors_total", "Errors returned by X, by account and error type.")
+metrics.histogram("tweetky_send_seconds", "Time to send a message to WhatsApp, by the type of its first media (text if none).", REQUEST_SECONDS_BUCKETS)
+metrics.counter("tweetky_sends_total", "Deliveries to WhatsApp, by media type and result (ok, error, skipped).")
+metrics.histogram("tweetky_delivery_lag_seconds", "Time from a tweet being posted on X to it being delivered to WhatsApp.", DELIVERY_LAG_SECONDS_BUCKETS)
+metrics.counter("tweetky_media_downloaded_bytes_total", "Media bytes downloaded from X's CDN.")
+metrics.counter("tweetky_media_uploaded_bytes_total", "Media bytes uploaded to the WhatsApp API.")
+metrics.collector("tweetky_send_queue_depth", "gauge", "Messages waiting in the send queue.", lambda: len(send_queue.data))
+metrics.collector("tweetky_send_queue_oldest_seconds", "gauge", "Age of the oldest message in the send queue.", lambda: send_queue.stats()["oldest_age_seconds"])
+metrics.collector("tweetky_retry_queue_depth", "gauge", "Failed deliveries waiting to be retried.", lambda: len(retry_queue.data))
+metrics.collector("tweetky_dead_letters", "gauge", "Deliveries given up on after RETRY_MAX_ATTEMPTS.", lambda: len(retry_queue.dead_letters.data))
+metrics.collector("tweetky_media_cache_hits_total", "counter", "Media cache lookups that found the file.", lambda: media_cache.hits)
+metrics.collector("tweetky_media_cache_misses_total", "counter", "Media cache lookups that didn't find the file.", lambda: media_cache.misses)
+metrics.collector("tweetky_media_cache_bytes", "gauge", "Disk space used by the media cache.", lambda: media_cache.total_bytes())
+metrics.collector("tweetky_last_round_timestamp_seconds", "gauge", "When the last poll round finished.", lambda: metrics.last_round_at or 0)
+
+async def start_metrics_server() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+
+    async def serve_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    async def serve_liveness(request):
+        return web.Response(text="ok\n" if metrics.is_live() else "stalled\n", status=200 if metrics.is_live() else 503)
+
+    async def serve_readiness(request):
+        return web.Response(text="ready\n" if metrics.ready else "starting\n", status=200 if metrics.ready else 503)
+
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    app.router.add_get("/healthz", serve_liveness)
+    app.router.add_get("/readyz", serve_readiness)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", METRICS_PORT).start()
+    print(f"Serving metrics and health checks on port {METRICS_PORT}.")
+    return runner
+
+class PooledSession:
+    """
+    One keep-alive aiohttp session shared by every request to a host,
+    created on first use and closed on shutdown.
+    """
+    def __init__(self, headers: dict[str, str], limit: int):
+        self.headers = headers
+        self.limit = limit
+        self.session: aiohttp.ClientSession | None = None
+
+    def get(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    keepalive_timeout=60,
+                    ttl_dns_cache=300,
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=WHATSAPP_REQUEST_TIMEOUT,
+                    sock_connect=WHATSAPP_CONNECT_TIMEOUT,
+                ),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+whatsapp = PooledSession(WHATSAPP_HEADERS, WHATSAPP_POOL_LIMIT)
+# X's media CDN gets its own pool, and never the gateway's credentials. A
+# download streaming into an upload holds its connection until the upload
+# is done, so sharing the gateway's pool could leave the upload none
+cdn = PooledSession({}, PREFETCH_CONCURRENCY + SEND_WORKERS + 1)
+
+async def verify_whatsapp_login():
+    print("Verifying WhatsApp is logged in...", '/app/login')
+    while True:
+        try:
+            async with whatsapp.get().get(f'{WHATSAPP_URL}/app/login') as response:
+                if response.status == 401:
+                    raise Exception(f"WhatsApp API returned status code {response.status}: {await response.text()}")
+
+                data = await response.json(content_type=None)
+
+            if data.get("code") == "SUCCESS" and data.get("results", {}).get("qr_link"):
+                raise Exception(f"Login to WhatsApp @ {data.get('results', {}).get('qr_link')}")
+            elif data.get("code") == "ALREADY_LOGGED_IN":
+                print("WhatsApp is logged in!")
+                break
+            elif data.get("code") == "SESSION_SAVED_ERROR":
+                print("WhatsApp session already saved, proceeding with the script.")
+                print("Retrying in 2 seconds...")
+                await asyncio.sleep(2)
+                continue
+            else:
+                raise Exception(f"WhatsApp API returned unexpected response: {data}")
+
+        except aiohttp.ClientConnectorError:
+            print("WhatsApp API not yet started...")
+            await asyncio.sleep(2)
+        except Exception as e:
+            print(f"WhatsApp API authentication failed.")
+            raise e
+
+async def print_public_ip():
+    response = await asyncio.to_thread(requests.get, 'https://ifconfig.me/', timeout=10)
+    print(f"Your IP address: {response.text.strip()}")
+
+async def wait_for_warp_proxy():
+    print("Verifying WARP is working...")
+    while True:
+        try:
+            response = await asyncio.to_thread(requests.get, 'https://ifconfig.me/', proxies={'http': WARP_PROXY_URL, 'https': WARP_PROXY_URL}, timeout=10)
+            print(f"Your IP through proxy: {response.text.strip()}")
+            break
+        except requests.exceptions.ConnectionError as e:
+            if "[Errno 111] Connection refused" in str(e):
+                print("WARP Proxy not yet started...")
+                await asyncio.sleep(2)
+                continue
+            else:
+                raise e
+
 class PersistentJsonData:
     def __init__(self, filename, default_data):
         self.filename = filename
@@ -115,141 +452,1219 @@ class PersistentJsonData:
         self.save_to_file()
 
     def save_to_file(self):
-        with open(DATA_DIR + self.filename, 'w+') as f:
-            json.dump(self.data, f)
+        self._write_atomically(self.data)
+
+    def _write_atomically(self, data):
+        # Write beside the real file and swap it in, so a crash mid-write
+        # never leaves a truncated JSON file behind
+        tmp_filename = DATA_DIR + self.filename + ".tmp"
+        with open(tmp_filename, 'w+') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, DATA_DIR + self.filename)
+
+def snowflake_to_datetime(snowflake) -> datetime.datetime:
+    """
+    Recover the creation time embedded in a Twitter snowflake ID.
+    """
+    return datetime.datetime.fromtimestamp(
+        ((int(snowflake) >> 22) + TWITTER_EPOCH_MS) / 1000,
+        tz=datetime.timezone.utc
+    )
+
+def delivery_key(tweet_id: str, channel: str) -> str:
+    """
+    Key a delivery of a tweet to one channel is tracked under. Deliveries to
+    CHANNEL_ID use the bare tweet ID, so state from before routing existed
+    keeps working.
+    """
+    return tweet_id if channel == CHANNEL_ID else f"{tweet_id}:{channel}"
+
+class MediaRecord:
+    """
+    The few fields of a photo, video or GIF that are needed to send it. Its
+    JSON form is the same dict the queue files have always held.
+    """
+    __slots__ = ("type", "url", "poster", "width", "height", "bitrate", "duration_millis")
+
+    def __init__(self, type: str, url: str, poster: str | None = None, width: int | None = None, height: int | None = None,
+                 bitrate: int | None = None, duration_millis: int | None = None):
+        self.type = type
+        self.url = url
+        self.poster = poster
+        self.width = width
+        self.height = height
+        self.bitrate = bitrate
+        self.duration_millis = duration_millis
+
+    @classmethod
+    def from_json(cls, data: dict) -> "MediaRecord":
+        size = data.get("size", {})
+        if data["type"] == "photo":
+            return cls("photo", data["url"], width=size.get("width"), height=size.get("height"))
+
+        video = data["video"]
+        return cls(data["type"], video["url"], data.get("poster"), size.get("width"), size.get("height"),
+                   video.get("bitrate"), video.get("duration_millis"))
+
+    def to_json(self) -> dict:
+        size = {"height": self.height, "width": self.width}
+        if self.type == "photo":
+            return {"type": "photo", "url": self.url, "size": size}
+
+        return {
+            "type": self.type,
+            "poster": self.poster,
+            "size": size,
+            "video": {
+                "bitrate": self.bitrate,
+                "url": self.url,
+                "duration_millis": self.duration_millis,
+            }
+        }
+
+class TweetRecord:
+    """
+    What's kept of a fetched tweet, read off twikit's Tweet (with its raw
+    payload and nested User) right after the fetch so those can be dropped.
+    """
+    __slots__ = ("id", "screen_name", "is_blue_verified", "text", "created_at", "media", "media_error")
+
+    def __init__(self, id: str, screen_name: str, is_blue_verified: bool, text: str, created_at: str,
+                 media: tuple[MediaRecord, ...] = (), media_error: str | None = None):
+        self.id = id
+        self.screen_name = screen_name
+        self.is_blue_verified = is_blue_verified
+        self.text = text
+        self.created_at = created_at
+        self.media = media
+        self.media_error = media_error
+
+    @classmethod
+    def from_tweet(cls, tweet: Tweet) -> "TweetRecord":
+        text, media, media_error = tweet.full_text, (), None
+        for tweet_media in tweet.media or []:
+            # The media's t.co link is only a placeholder in the text
+            text = text.replace(tweet_media.url, "")
+
+        try:
+            media = tuple(map(build_tweet_media, tweet.media or []))
+        except Exception as e:
+            # Surfaces when the tweet is queued, so it's marked as errored like before
+            media_error = f"{type(e).__name__}: {e}"
+
+        return cls(tweet.id, tweet.user.screen_name, bool(tweet.user.is_blue_verified), text, tweet.created_at, media, media_error)
+
+class DeliveryItem:
+    """
+    A built message for one channel, as held by the send queue and the retry
+    queue.
+    """
+    __slots__ = ("id", "screen_name", "created_at", "channel", "text", "media", "enqueued_at", "attempts", "last_error", "retry_at", "fingerprints", "sent_media")
+
+    def __init__(self, id: str, screen_name: str, created_at: str, channel: str, text: str, media: tuple[MediaRecord, ...],
+                 enqueued_at: float, attempts: int = 0, last_error: str | None = None, retry_at: float | None = None,
+                 fingerprints: tuple[str, ...] = (), sent_media: int = 0):
+        self.id = id
+        self.screen_name = screen_name
+        self.created_at = created_at
+        self.channel = channel
+        self.text = text
+        self.media = media
+        self.enqueued_at = enqueued_at
+        self.attempts = attempts
+        self.last_error = last_error
+        self.retry_at = retry_at
+        # What the tweet's content is matched on (see content_fingerprints_of)
+        self.fingerprints = fingerprints
+        # Parts (the text or captioned first media, then each other media)
+        # already sent, a retry carries on after them
+        self.sent_media = sent_media
+
+    @property
+    def key(self) -> str:
+        return delivery_key(self.id, self.channel)
+
+    def replace(self, **changes) -> "DeliveryItem":
+        return DeliveryItem(**{**{name: getattr(self, name) for name in self.__slots__}, **changes})
+
+    @classmethod
+    def from_json(cls, data: dict) -> "DeliveryItem":
+        return cls(
+            data["id"], data["screen_name"], data["created_at"], data["channel"], data["text"],
+            tuple(map(MediaRecord.from_json, data["media"])), data["enqueued_at"],
+            data.get("attempts", 0), data.get("last_error"), data.get("retry_at"), tuple(data.get("fingerprints", ())),
+            data.get("sent_media", 0)
+        )
+
+    def to_json(self) -> dict:
+        data = {
+            "id": self.id,
+            "screen_name": self.screen_name,
+            "created_at": self.created_at,
+            "channel": self.channel,
+            "text": self.text,
+            "media": [media.to_json() for media in self.media],
+            "enqueued_at": self.enqueued_at,
+        }
+        if self.attempts:
+            data.update(attempts=self.attempts, last_error=self.last_error, retry_at=self.retry_at)
+        if self.fingerprints:
+            data["fingerprints"] = list(self.fingerprints)
+        if self.sent_media:
+            data["sent_media"] = self.sent_media
+        return data
 
 class PersistentSet(PersistentJsonData):
+    """
+    Set of delivery keys (see `delivery_key`) backed by a JSON snapshot plus
+    an append-only journal.
+
+    Lookups hit an in-memory hash index, every write appends a single line to
+    `<filename>.log`, and the journal is folded back into the snapshot (dropping
+    IDs older than DEDUP_RETENTION_DAYS) every DEDUP_COMPACT_EVERY writes.
+    Nothing is read until the set is first used, or `load` is called.
+    """
     def __init__(self, filename):
-        super().__init__(filename, [])
-        
-        print(f"Initialized PersistentSet with {len(self.data)} items.")
+        self.filename = filename
+        self.journal_filename = filename + ".log"
+        self.journal_size = 0
+        self._data: set[str] | None = None
 
-    async def add(self, tweet: Tweet):
-        self.data.append(tweet.id)
-        self.save_to_file()
+    @property
+    def data(self) -> set[str]:
+        # Read from disk on first use, unless `load` already ran during startup
+        if self._data is None:
+            self.load()
+        return self._data
+
+    @data.setter
+    def data(self, data: set[str]):
+        self._data = data
+
+    def load(self):
+        if self._data is not None:
+            return
+
+        try:
+            with open(DATA_DIR + self.filename, 'r') as f:
+                data = set(json.load(f))
+        except FileNotFoundError:
+            data = set()
+
+        try:
+            with open(DATA_DIR + self.journal_filename, 'r') as f:
+                for line in f:
+                    # A line without its newline was torn by a crash mid-write
+                    if not line.endswith("\n"):
+                        continue
+                    op, key = line[0], line[1:].strip()
+                    if op == "+":
+                        data.add(key)
+                    elif op == "-":
+                        data.discard(key)
+        except FileNotFoundError:
+            pass
+
+        self._data = data
+        self.compact()
+
+        print(f"Loaded {self.filename} with {len(self._data)} items.")
+
+    async def add(self, key: str):
+        self.data.add(key)
+        self._append_to_journal("+", key)
+
+    async def remove(self, key: str):
+        self.data.discard(key)
+        self._append_to_journal("-", key)
+
+    def exists(self, key: str):
+        return key in self.data or self.is_expired(key)
+
+    def is_expired(self, key: str) -> bool:
+        # Anything past the retention window has been pruned from the index,
+        # so it must count as seen or it would be sent a second time.
+        if DEDUP_RETENTION_DAYS <= 0:
+            return False
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=DEDUP_RETENTION_DAYS)
+        return snowflake_to_datetime(key.split(":")[0]) < cutoff
+
+    def _append_to_journal(self, op: str, key: str):
+        with open(DATA_DIR + self.journal_filename, 'a') as f:
+            f.write(f"{op}{key}\n")
+            f.flush()
+            os.fsync(f.fileno())
 
-    async def remove(self, tweet: Tweet):
-        self.data.remove(tweet.id)
+        self.journal_size += 1
+        if self.journal_size >= DEDUP_COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        self.data = {key for key in self.data if not self.is_expired(key)}
         self.save_to_file()
 
-    def exists(self, tweet: Tweet):
-        return tweet.id in self.data
+        # Snapshot is durable now, the journal can start over
+        with open(DATA_DIR + self.journal_filename, 'w'):
+            pass
+        self.journal_size = 0
 
     def save_to_file(self):
-        with open(DATA_DIR + self.filename, 'w+') as f:
-            json.dump(self.data, f)
+        self._write_atomically(sorted(self.data))
+
+class SharedSet(PersistentSet):
+    """
+    PersistentSet of deliveries that must never go out again, mirrored into
+    the replicas' shared table when COORDINATION_DB is set.
+    """
+    async def add(self, key: str):
+        await super().add(key)
+        if coordinator:
+            await asyncio.to_thread(coordinator.mark_sent, key)
 
-class SentTweets(PersistentSet):
+class SentTweets(SharedSet):
     def __init__(self, filename="sent_tweets.json"):
         super().__init__(filename)
-        self.errored = PersistentSet("errored_tweets.json")
+        self.errored = SharedSet("errored_tweets.json")
+
+    def load(self):
+        super().load()
+        self.errored.load()
+
+    async def deliver(self, item: DeliveryItem):
+        key = item.key
+        if key in self.data:
+            # Sent, but the process died before it left the queue file
+            print(f"Tweet {item.id} to {item.channel} was already sent, skipping.")
+            return
+
+        outgoing = item
+        # Matched against what actually reached the channel, right before
+        # sending. Partly sent already, the rest goes out as it was
+        original = None if item.sent_media else content_fingerprints.original_of(item)
+        if original is not None:
+            if CONTENT_DEDUP_MODE == "skip":
+                print(f"Tweet {item.id} duplicates {original['id']} by @{original['screen_name']} in {item.channel}, skipping.")
+                await self.add(key)
+                return
+            else:
+                print(f"Tweet {item.id} duplicates {original['id']} by @{original['screen_name']} in {item.channel}, sending a short note instead.")
+                outgoing = collapse_duplicate(item, original)
+
+        media_type = outgoing.media[0].type if outgoing.media else "text"
+        if coordinator and not await asyncio.to_thread(coordinator.claim_delivery, key):
+            print(f"Tweet {item.id} to {item.channel} was already sent by another replica, skipping.")
+            metrics.inc("tweetky_sends_total", media_type=media_type, result="skipped")
+            return
 
-    async def add(self, tweet: Tweet):
+        started_at = time.monotonic()
         try:
-            await self.__send_request_to_post_video(tweet)
+            await self.__send_request_to_post_video(outgoing)
 
-            self.data.append(tweet.id)
-            self.save_to_file()
+            await self.add(key)
+            if outgoing is item:
+                content_fingerprints.record(item)
+
+            metrics.observe("tweetky_send_seconds", time.monotonic() - started_at, media_type=media_type)
+            metrics.inc("tweetky_sends_total", media_type=media_type, result="ok")
+            metrics.observe("tweetky_delivery_lag_seconds", time.time() - parse_tweet_time(item.created_at).timestamp())
             
         except Exception as e:
-            await self.errored.add(tweet)
-
             print("Failed to send request to post message to WhatsApp.", e)
             traceback.print_exc()
 
-    async def __send_request_to_post_video(self, tweet: Tweet):
-        async with aiohttp.ClientSession() as session:
-            # Post to WhatsApp
-            session.headers.update(WHATSAPP_HEADERS)
-
-            tweet_text: str = build_tweet_text(tweet)
-            tweet_medias = [] if not tweet.media else list(map(build_tweet_media, tweet.media))
-
-            async def send_media_photo(media, caption: str = ""):
-                async with session.post(f'{WHATSAPP_URL}/send/image', json={
-                    "image_url": media["url"],
-                    "phone": CHANNEL_ID,
-                    "caption": caption
-                }) as response:
+            metrics.inc("tweetky_sends_total", media_type=media_type, result="error")
+
+            if coordinator:
+                await asyncio.to_thread(coordinator.release_delivery, key)
+            await retry_queue.failed(item, e)
+
+    async def __send_request_to_post_video(self, item: DeliveryItem):
+        # Post to WhatsApp
+        session = whatsapp.get()
+
+        channel_id = item.channel
+        tweet_text: str = item.text
+        tweet_medias = item.media
+
+        async def send_media_photo(media: MediaRecord, caption: str = ""):
+            await whatsapp_sends.acquire()
+            async with session.post(f'{WHATSAPP_URL}/send/image', json={
+                "image_url": media.url,
+                "phone": channel_id,
+                "caption": caption
+            }) as response:
+                res = await response.json()
+                if res["code"] != "SUCCESS":
+                    print("Failed to send photo to WhatsApp API.")
+                    print(res)
+                    raise Exception("Failed to send photo to WhatsApp API.")
+                else:
+                    print("Sent photo to WhatsApp API.")
+        
+        async def send_media_video(media: MediaRecord, caption = ""):
+            video_url = media.url
+
+            form = aiohttp.FormData()
+            form.add_field("phone", channel_id)
+            form.add_field("compress", "true")
+            if caption != "":
+                form.add_field("caption", caption)
+
+            async def post_video_form():
+                await whatsapp_sends.acquire()
+                async with session.post(f"{WHATSAPP_URL}/send/video", data=form) as response:
                     res = await response.json()
                     if res["code"] != "SUCCESS":
-                        print("Failed to send photo to WhatsApp API.")
+                        print("Failed to send video to WhatsApp API.")
                         print(res)
-                        raise Exception("Failed to send photo to WhatsApp API.")
+                        raise Exception("Failed to send video to WhatsApp API.")
                     else:
-                        print("Sent photo to WhatsApp API.")
-            
-            async def send_media_video(media, caption = ""):
-                video_url = media["video"]["url"]
-
-                # Stream video directly from URL
-                async with session.get(video_url) as video_response:
-                    video_bytes = await video_response.read()
-
-                    form = aiohttp.FormData()
-                    form.add_field("phone", CHANNEL_ID)
-                    form.add_field("video", BytesIO(video_bytes),
+                        print(res)
+                        print("Sent video to WhatsApp API.")
+
+            video_path = await media_prefetcher.take(video_url)
+            if video_path is None and WHATSAPP_VIDEO_MODE != "url":
+                # Not prefetched (the tweet being sent, over the cap, or a
+                # retry), a cached copy still saves the download
+                video_path = media_cache.lookup(video_url)
+
+            if WHATSAPP_VIDEO_MODE == "url":
+                # Gateway fetches the video itself, no bytes pass through us
+                form.add_field("video_url", video_url)
+                await post_video_form()
+            elif video_path is not None:
+                with open(video_path, "rb") as video_file:
+                    # Sized up front, an unpinned file can be evicted mid-upload
+                    video_bytes = os.fstat(video_file.fileno()).st_size
+                    form.add_field("video", video_file,
                                 filename="video.mp4",
                                 content_type="video/mp4")
-                    form.add_field("compress", "true")
-                    if caption != "":
-                        form.add_field("caption", caption)
-
-                    async with session.post(f"{WHATSAPP_URL}/send/video", data=form) as response:
-                        res = await response.json()
-                        if res["code"] != "SUCCESS":
-                            print("Failed to send video to WhatsApp API.")
-                            print(res)
-                            raise Exception("Failed to send video to WhatsApp API.")
-                        else:
-                            print(res)
-                            print("Sent video to WhatsApp API.")
-
-            async def send_text_message(tweet_text: str):
-                # Send message to WhatsApp API
-                async with session.post(f'{WHATSAPP_URL}/send/message', json={
-                    "message": tweet_text,
-                    "phone": CHANNEL_ID,
-                }) as response:
-                    res = await response.json()
-                    if res["code"] != "SUCCESS":
-                        print("Failed to send message to WhatsApp API.")
-                        print(res)
-                        raise Exception("Failed to send message to WhatsApp API.")
-                    else:
-                        print("Sent message to WhatsApp API.")
-
-            if len(tweet_medias) == 0:
-                print("No media found in tweet, sending text message...")
-                await send_text_message(tweet_text)
-            elif len(tweet_medias) == 1:
-                first_media = tweet_medias[0]
-                if first_media["type"] == "photo":
-                    print("Sending single photo...")
-                    await send_media_photo(first_media, tweet_text)
+                    await post_video_form()
+                metrics.inc("tweetky_media_uploaded_bytes_total", video_bytes)
+            else:
+                # Pipe the CDN body into the upload chunk by chunk, so only the
+                # stream's read buffer is ever held in memory. A copy lands in
+                # the cache on the way for the tweet's other channels and retries
+                keep = media_cache.fits(estimate_variant_bytes({"bitrate": media.bitrate}, media.duration_millis))
+                async with cdn.get().get(video_url) as video_response:
+                    video_response.raise_for_status()
+                    chunks = media_cache.write_through(video_url, video_response.content.iter_chunked(64 * 1024), keep)
+                    async with aclosing(chunks):
+                        form.add_field("video", chunks,
+                                    filename="video.mp4",
+                                    content_type="video/mp4")
+                        await post_video_form()
+
+                    streamed_bytes = video_response.content.total_bytes
+                    metrics.inc("tweetky_media_downloaded_bytes_total", streamed_bytes)
+                    metrics.inc("tweetky_media_uploaded_bytes_total", streamed_bytes)
+
+        async def send_text_message(tweet_text: str):
+            # Send message to WhatsApp API
+            await whatsapp_sends.acquire()
+            async with session.post(f'{WHATSAPP_URL}/send/message', json={
+                "message": tweet_text,
+                "phone": channel_id,
+            }) as response:
+                res = await response.json()
+                if res["code"] != "SUCCESS":
+                    print("Failed to send message to WhatsApp API.")
+                    print(res)
+                    raise Exception("Failed to send message to WhatsApp API.")
                 else:
-                    print("Sending single video...")
-                    await send_media_video(first_media, tweet_text)
+                    print("Sent message to WhatsApp API.")
+
+        async def send_part(index: int, send: Callable[[], Awaitable[None]]):
+            # A retry skips whatever went out before the failure
+            if index < item.sent_media:
+                print(f"Part {index + 1} was sent before, skipping.")
+                return
+            await send()
+            item.sent_media = index + 1
+
+        if len(tweet_medias) == 0:
+            print("No media found in tweet, sending text message...")
+            await send_part(0, lambda: send_text_message(tweet_text))
+        elif len(tweet_medias) == 1:
+            first_media = tweet_medias[0]
+            if first_media.type == "photo":
+                print("Sending single photo...")
+                await send_part(0, lambda: send_media_photo(first_media, tweet_text))
+            else:
+                print("Sending single video...")
+                await send_part(0, lambda: send_media_video(first_media, tweet_text))
+        else:
+            first_media = tweet_medias[0]
+            if first_media.type == "photo":
+                print("Sending first photo...")
+                await send_part(0, lambda: send_media_photo(first_media, tweet_text  + "\n\n*More photos/videos from tweet below...*"))
             else:
-                first_media = tweet_medias[0]
-                if first_media["type"] == "photo":
-                    print("Sending first photo...")
-                    await send_media_photo(first_media, tweet_text  + "\n\n*More photos/videos from tweet below...*")
+                print("Sending first video...")
+                await send_part(0, lambda: send_media_video(first_media, tweet_text  + "\n\n*More photos/videos from tweet below...*"))
+
+            for index, media in enumerate(tweet_medias[1:], 1):
+                print("Sending media...")
+                if media.type == "photo":
+                    await send_part(index, lambda: send_media_photo(media))
                 else:
-                    print("Sending first video...")
-                    await send_media_video(first_media, tweet_text  + "\n\n*More photos/videos from tweet below...*")
+                    await send_part(index, lambda: send_media_video(media))
 
-                for media in tweet_medias[1:]:
-                    print("Sending media...")
-                    if media["type"] == "photo":
-                        await send_media_photo(media)
-                    else:
-                        await send_media_video(media)
+class UserIdCache(PersistentJsonData):
+    """
+    Screen name -> user ID lookups kept for USER_ID_CACHE_TTL_HOURS, so a
+    sweep only needs one timeline request per handle.
+    """
+    def __init__(self, filename="user_ids.json"):
+        super().__init__(filename, {})
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, screen_name: str) -> str | None:
+        entry = self.data.get(screen_name.lower())
+        if entry and time.time() - entry["resolved_at"] < USER_ID_CACHE_TTL_HOURS * 60 * 60:
+            self.hits += 1
+            return entry["id"]
+
+        self.misses += 1
+        return None
+
+    def put(self, screen_name: str, user: twikit.User) -> str:
+        self.data[screen_name.lower()] = {
+            "id": user.id,
+            "screen_name": user.screen_name,
+            "resolved_at": time.time(),
+        }
+        self.save_to_file()
+        return user.id
+
+    def invalidate(self, screen_name: str):
+        if self.data.pop(screen_name.lower(), None) is not None:
+            self.save_to_file()
+
+class HandleCursors(PersistentJsonData):
+    """
+    Per-handle newest-seen tweet ID plus the page size to ask for next time,
+    sized from how many tweets the handle posted between the last two sweeps.
+    """
+    def __init__(self, filename="handle_cursors.json"):
+        super().__init__(filename, {})
+
+    def newest_id(self, screen_name: str) -> int | None:
+        entry = self.data.get(screen_name.lower())
+        return int(entry["newest_id"]) if entry else None
+
+    def page_size(self, screen_name: str) -> int:
+        entry = self.data.get(screen_name.lower())
+        return entry["page_size"] if entry else HANDLE_PAGE_SIZE_MAX
+
+    def update(self, screen_name: str, tweets: list[TweetRecord]):
+        if not tweets:
+            return
+
+        newest_seen_id = self.newest_id(screen_name)
+        tweet_ids = [int(tweet.id) for tweet in tweets]
+        new_count = len([tweet_id for tweet_id in tweet_ids if newest_seen_id is None or tweet_id > newest_seen_id])
+
+        self.data[screen_name.lower()] = {
+            "newest_id": str(max(tweet_ids + ([newest_seen_id] if newest_seen_id else []))),
+            "page_size": min(HANDLE_PAGE_SIZE_MAX, max(HANDLE_PAGE_SIZE_MIN, new_count * 2)),
+        }
+        self.save_to_file()
+
+class PostingRates(PersistentJsonData):
+    """
+    Smoothed posts/hour per handle, estimated from the `created_at` times of
+    each fetched page.
+    """
+    def __init__(self, filename="posting_rates.json"):
+        super().__init__(filename, {})
+
+    def get(self, screen_name: str) -> float | None:
+        return self.data.get(screen_name.lower())
+
+    def observe(self, screen_name: str, tweets: list[TweetRecord]):
+        if not tweets:
+            return
+
+        created_at = [parse_tweet_time(tweet.created_at).timestamp() for tweet in tweets]
+        span_hours = max(1.0, (time.time() - min(created_at)) / (60 * 60))
+        sample = len(created_at) / span_hours
+
+        previous = self.get(screen_name)
+        self.data[screen_name.lower()] = sample if previous is None else (previous + sample) / 2
+        self.save_to_file()
+
+class PollingSchedule:
+    """
+    Per-handle next-poll times. Busy handles are polled every
+    1 / posts_per_hour hours (clamped to X_POLL_MIN/MAX_MINUTES), and slowed
+    down if the total would go over X_POLL_BUDGET_PER_HANDLE polls/hour on
+    average.
+    """
+    def __init__(self, user_handles: list[str]):
+        self.user_handles = user_handles
+        self.next_poll_at = {user_handle: 0.0 for user_handle in user_handles}
+
+    def base_interval(self, user_handle: str) -> float:
+        posts_per_hour = posting_rates.get(user_handle)
+        if not posts_per_hour:
+            return X_POLL_MAX_MINUTES * 60
+        interval = 60 * 60 / posts_per_hour
+        return min(X_POLL_MAX_MINUTES * 60, max(X_POLL_MIN_MINUTES * 60, interval))
+
+    def interval(self, user_handle: str) -> float:
+        max_interval = X_POLL_MAX_MINUTES * 60
+        budget = X_POLL_BUDGET_PER_HANDLE * len(self.user_handles)
+        base_intervals = {handle: self.base_interval(handle) for handle in self.user_handles}
+
+        # Quiet handles already sit at the max interval, only busier ones are
+        # slowed down to fit whatever budget is left over.
+        quiet_polls = sum(60 * 60 / interval for interval in base_intervals.values() if interval >= max_interval)
+        busy_polls = sum(60 * 60 / interval for interval in base_intervals.values() if interval < max_interval)
+        budget_left = budget - quiet_polls
+
+        if budget_left <= 0:
+            return base_intervals[user_handle] * (quiet_polls + busy_polls) / budget
+        if busy_polls > budget_left and base_intervals[user_handle] < max_interval:
+            return min(max_interval, base_intervals[user_handle] * busy_polls / budget_left)
+        return base_intervals[user_handle]
+
+    def schedule(self, user_handle: str):
+        interval = self.interval(user_handle)
+        self.next_poll_at[user_handle] = time.time() + generate_time_interval(interval * 0.75, interval * 1.25)
+
+    def due_handles(self, user_handles: list[str]) -> list[str]:
+        now = time.time()
+        return [user_handle for user_handle in user_handles if self.next_poll_at[user_handle] <= now]
+
+    def seconds_until_timeline_poll(self) -> float:
+        # One timeline request covers every handle, so the busiest one sets the pace
+        interval = min(self.base_interval(user_handle) for user_handle in self.user_handles)
+        return round(generate_time_interval(interval * 0.75, interval * 1.25), 2)
+
+    def seconds_until_next_poll(self, user_handles: list[str]) -> tuple[float, str]:
+        user_handle = min(user_handles, key=self.next_poll_at.get)
+        return max(1.0, round(self.next_poll_at[user_handle] - time.time(), 2)), user_handle
+
+class SendQueue(PersistentJsonData):
+    """
+    Durable queue of built messages waiting to be delivered (send_queue.json),
+    one item per (tweet, channel).
+
+    Items only leave the file once they're sent or errored, so anything still
+    pending when the process dies is delivered after a restart. Each channel
+    is drained oldest tweet first (snowflake IDs sort by creation time), one
+    item at a time, however many workers there are.
+    """
+    def __init__(self, filename="send_queue.json"):
+        super().__init__(filename, [])
+        self.data = [DeliveryItem.from_json(item) for item in self.data]
+        self.keys = {item.key for item in self.data}
+        self.busy_channels = set()
+        self.in_flight_keys = set()
+        self.condition = asyncio.Condition()
+
+        print(f"Initialized SendQueue with {len(self.data)} pending items.")
+
+    def contains(self, key: str) -> bool:
+        return key in self.keys
+
+    async def put(self, item: DeliveryItem):
+        async with self.condition:
+            self.data.append(item)
+            self.keys.add(item.key)
+            self.save_to_file()
+            self.condition.notify_all()
+
+    async def get(self) -> DeliveryItem:
+        async with self.condition:
+            while (item := self._next_item()) is None:
+                await self.condition.wait()
+
+            self.busy_channels.add(item.channel)
+            self.in_flight_keys.add(item.key)
+            return item
+
+    async def done(self, item: DeliveryItem):
+        async with self.condition:
+            self.data.remove(item)
+            self.keys.discard(item.key)
+            self.busy_channels.discard(item.channel)
+            self.in_flight_keys.discard(item.key)
+            self.save_to_file()
+            self.condition.notify_all()
+
+    def save_to_file(self):
+        self._write_atomically([item.to_json() for item in self.data])
+
+    def _next_item(self) -> DeliveryItem | None:
+        ready = [item for item in self.data if item.channel not in self.busy_channels]
+        return min(ready, key=lambda item: int(item.id), default=None)
+
+    async def claim_idle_channel(self, channel: str) -> bool:
+        """
+        Reserve a channel for an out-of-band send, only if nothing is being
+        sent to it and no queued tweet is waiting for it.
+        """
+        async with self.condition:
+            if channel in self.busy_channels or any(item.channel == channel for item in self.data):
+                return False
+
+            self.busy_channels.add(channel)
+            return True
+
+    async def release_channel(self, channel: str):
+        async with self.condition:
+            self.busy_channels.discard(channel)
+            self.condition.notify_all()
+
+    def upcoming(self, count: int) -> list[DeliveryItem]:
+        waiting = [item for item in self.data if item.key not in self.in_flight_keys]
+        return sorted(waiting, key=lambda item: int(item.id))[:count]
+
+    def siblings(self, item: DeliveryItem) -> list[DeliveryItem]:
+        """
+        The same tweet's items for other channels.
+        """
+        return [other for other in self.data if other.id == item.id and other.channel != item.channel]
+
+    def stats(self) -> dict:
+        oldest = min((item.enqueued_at for item in self.data), default=None)
+        return {
+            "depth": len(self.data),
+            "oldest_age_seconds": 0 if oldest is None else round(time.time() - oldest, 2),
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Send queue: {stats['depth']} pending, oldest queued {stats['oldest_age_seconds']}s ago.")
+
+class MediaCache:
+    """
+    Downloaded media under DATA_DIR/media_cache/, one file per media URL
+    (named by its hash, X never changes what's behind a media URL). Files
+    are written chunk by chunk as they download, and the least recently used
+    ones are evicted once MEDIA_CACHE_MAX_MB is exceeded, except those still
+    pinned by a queued send.
+    """
+    def __init__(self, directory=DATA_DIR + "media_cache/", max_bytes=MEDIA_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # path -> size, least recently used first
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.pins: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for file in os.listdir(self.directory):
+            path = self.directory + file
+            # Torn by a crash mid-download
+            if file.endswith(".part"):
+                os.remove(path)
+                continue
+            entries.append((os.path.getmtime(path), path, os.path.getsize(path)))
+        for _, path, size in sorted(entries):
+            self.files[path] = size
+        self._evict()
+
+        print(f"Initialized MediaCache with {len(self.files)} files, {round(self.total_bytes() / 1024 / 1024, 2)}MB.")
+
+    def path_for(self, url: str) -> str:
+        return self.directory + hashlib.sha256(url.encode()).hexdigest() + ".mp4"
+
+    def total_bytes(self) -> int:
+        return sum(self.files.values())
+
+    def fits(self, size: float) -> bool:
+        return self.max_bytes > 0 and size <= self.max_bytes
+
+    def contains(self, url: str) -> bool:
+        return self.path_for(url) in self.files
+
+    def lookup(self, url: str) -> str | None:
+        """
+        Path of the cached copy of `url`, or None. A copy found counts as a
+        hit, misses are counted by the download that replaces it.
+        """
+        path = self.path_for(url)
+        if path not in self.files:
+            return None
+
+        self.hits += 1
+        self.bytes_saved += self.files[path]
+        self.files.move_to_end(path)
+        # mtime doubles as the LRU order after a restart
+        os.utime(path)
+        return path
+
+    def pin(self, url: str):
+        self.pins[url] = self.pins.get(url, 0) + 1
+
+    def unpin(self, url: str):
+        self.pins[url] -= 1
+        if not self.pins[url]:
+            del self.pins[url]
+            self._evict()
+
+    async def fetch(self, url: str) -> str | None:
+        """
+        Download `url` into the cache, or None if the download failed.
+        """
+        path = self.path_for(url)
+        self.misses += 1
+        try:
+            async with cdn.get().get(url) as response:
+                response.raise_for_status()
+                with open(path + ".part", "wb") as f:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        f.write(chunk)
+                        metrics.inc("tweetky_media_downloaded_bytes_total", len(chunk))
+
+            os.replace(path + ".part", path)
+        except BaseException as e:
+            if os.path.exists(path + ".part"):
+                os.remove(path + ".part")
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            print(f"Downloading {url} failed, it will be streamed instead.", e)
+            return None
+
+        self.files[path] = os.path.getsize(path)
+        self.files.move_to_end(path)
+        self._evict(keep=path)
+        return path
+
+    async def write_through(self, url: str, chunks: AsyncIterator[bytes], keep: bool) -> AsyncIterator[bytes]:
+        """
+        Pass a download of `url` through chunk by chunk, writing it into the
+        cache on the way if `keep`. Only a download that runs to the end is
+        kept.
+        """
+        path = self.path_for(url)
+        self.misses += 1
+        # Two channels can stream the same video at once
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        f = open(part_path, "wb") if keep else None
+        completed = False
+        try:
+            async for chunk in chunks:
+                if f is not None:
+                    f.write(chunk)
+                yield chunk
+            completed = True
+        finally:
+            if f is not None:
+                f.close()
+                if completed:
+                    os.replace(part_path, path)
+                    self.files[path] = os.path.getsize(path)
+                    self.files.move_to_end(path)
+                    self._evict(keep=path)
+                else:
+                    os.remove(part_path)
+
+    def _evict(self, keep: str | None = None):
+        pinned = {self.path_for(url) for url in self.pins}
+        total = self.total_bytes()
+        for path in list(self.files):
+            if total <= self.max_bytes:
+                break
+            if path in pinned or path == keep:
+                continue
+
+            total -= self.files.pop(path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self.files),
+            "bytes": self.total_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Media cache: {stats['files']} files ({round(stats['bytes'] / 1024 / 1024, 2)}MB), {stats['hits']} hits, {stats['misses']} misses ({stats['hit_ratio'] * 100:.1f}% hit ratio), {round(stats['bytes_saved'] / 1024 / 1024, 2)}MB of downloads saved.")
+
+class MediaPrefetcher:
+    """
+    Downloads the videos of the next few queued tweets, and the later videos
+    of the one being sent, into the media cache in the background, so each upload can start from disk instead of waiting
+    on X's CDN. A video is pinned in the cache
+    for as long as any queued item (e.g. each channel a tweet goes to) that
+    registered for it is waiting. Downloads not yet sent are capped by
+    PREFETCH_MAX_MB, anything that doesn't fit is streamed at send time.
+    """
+    def __init__(self):
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.reserved_bytes: dict[str, int] = {}
+        self.users: dict[str, set[str]] = {}
+        self.semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+    def prefetch(self, item: DeliveryItem):
+        if WHATSAPP_VIDEO_MODE == "url":
+            return
+
+        for media in item.media:
+            if media.type != "photo":
+                self._prefetch(item.key, media)
+
+    def hold(self, item: DeliveryItem):
+        """
+        Register the item being sent right now. Its first video is only held
+        (its send streams it), the ones after it download while it uploads.
+        """
+        if WHATSAPP_VIDEO_MODE == "url":
+            return
+
+        videos = [media for media in item.media if media.type != "photo"]
+        if not videos:
+            return
+
+        url = videos[0].url
+        if url in self.users:
+            self.users[url].add(item.key)
+        else:
+            media_cache.pin(url)
+            self.reserved_bytes[url] = 0
+            self.users[url] = {item.key}
+
+        for media in videos[1:]:
+            self._prefetch(item.key, media)
+
+    def _prefetch(self, key: str, media: MediaRecord):
+        url = media.url
+        if url in self.users:
+            self.users[url].add(key)
+            return
+
+        # The send looks it up, and counts the hit, itself
+        if media_cache.contains(url):
+            media_cache.pin(url)
+            self.reserved_bytes[url] = 0
+            self.users[url] = {key}
+            return
+
+        size = max(1024 * 1024, int(estimate_variant_bytes({"bitrate": media.bitrate}, media.duration_millis)))
+        if sum(self.reserved_bytes.values()) + size > PREFETCH_MAX_BYTES:
+            return
+
+        media_cache.pin(url)
+        self.reserved_bytes[url] = size
+        self.users[url] = {key}
+        self.tasks[url] = asyncio.create_task(self._download(url))
+
+    async def _download(self, url: str) -> str | None:
+        async with self.semaphore:
+            return await media_cache.fetch(url)
+
+    async def take(self, url: str) -> str | None:
+        """
+        Path of the prefetched video (waiting for it if still in progress), or
+        None if it wasn't prefetched.
+        """
+        task = self.tasks.get(url)
+        if task is not None:
+            return await asyncio.shield(task)
+        return None
+
+    def discard(self, item: DeliveryItem):
+        key = item.key
+        for media in item.media:
+            if media.type == "photo":
+                continue
+
+            url = media.url
+            if url not in self.users:
+                continue
+
+            self.users[url].discard(key)
+            if self.users[url]:
+                continue
+
+            del self.users[url]
+            del self.reserved_bytes[url]
+            task = self.tasks.pop(url, None)
+            if task is not None:
+                task.cancel()
+            media_cache.unpin(url)
+
+class RetryQueue(PersistentJsonData):
+    """
+    Failed deliveries waiting to be retried (retry_queue.json), spaced out
+    with exponential backoff and jitter. After RETRY_MAX_ATTEMPTS the item is
+    moved to dead_letters.json and its ID to errored_tweets.json.
+    """
+    def __init__(self, filename="retry_queue.json"):
+        super().__init__(filename, [])
+        self.data = [DeliveryItem.from_json(item) for item in self.data]
+        self.dead_letters = PersistentJsonData("dead_letters.json", [])
+
+        print(f"Initialized RetryQueue with {len(self.data)} items, {len(self.dead_letters.data)} dead letters.")
+
+    def contains(self, key: str) -> bool:
+        return any(item.key == key for item in self.data)
+
+    async def failed(self, item: DeliveryItem, error: Exception):
+        attempts = item.attempts + 1
+        retry = item.replace(attempts=attempts, last_error=str(error))
+
+        if attempts >= RETRY_MAX_ATTEMPTS:
+            self.dead_letters.data.append({**retry.to_json(), "dead_at": time.time()})
+            self.dead_letters.save_to_file()
+            await sent_tweets.errored.add(item.key)
+
+            print(f"Tweet {item.id} by @{item.screen_name} failed {attempts} times, giving up. See {DATA_DIR}dead_letters.json ({len(self.dead_letters.data)} total).")
+            return
+
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        delay = random.uniform(delay / 2, delay)
+
+        retry.retry_at = time.time() + delay
+        self.data.append(retry)
+        self.save_to_file()
+
+        print(f"Retrying tweet {item.id} in {round(delay)}s (attempt {attempts + 1} of {RETRY_MAX_ATTEMPTS}).")
+
+    def due(self) -> list[DeliveryItem]:
+        now = time.time()
+        return sorted((item for item in self.data if item.retry_at <= now), key=lambda item: item.retry_at)
+
+    def remove(self, item: DeliveryItem):
+        self.data.remove(item)
+        self.save_to_file()
+
+    def save_to_file(self):
+        self._write_atomically([item.to_json() for item in self.data])
+
+    def print_stats(self):
+        print(f"Retry queue: {len(self.data)} waiting, {len(self.dead_letters.data)} dead letters.")
+
+class ContentFingerprints(PersistentJsonData):
+    """
+    Fingerprints of what was delivered to each channel in the last
+    CONTENT_DEDUP_WINDOW_HOURS (content_fingerprints.json), so the same story
+    posted or reposted by several watched handles is only sent in full once,
+    whichever copy happens to go out first.
+    """
+    def __init__(self, filename="content_fingerprints.json"):
+        super().__init__(filename, {})
+
+    def original_of(self, item: DeliveryItem) -> dict | None:
+        """
+        The tweet already delivered to the item's channel that it duplicates, if any.
+        """
+        if CONTENT_DEDUP_WINDOW_HOURS <= 0:
+            return None
+
+        seen = self.data.get(item.channel, {})
+        cutoff = time.time() - CONTENT_DEDUP_WINDOW_HOURS * 60 * 60
+        for fingerprint in item.fingerprints:
+            original = seen.get(fingerprint)
+            if original and original["id"] != item.id and original["seen_at"] >= cutoff:
+                return original
+        return None
+
+    def record(self, item: DeliveryItem):
+        if CONTENT_DEDUP_WINDOW_HOURS <= 0:
+            return
+
+        now = time.time()
+        cutoff = now - CONTENT_DEDUP_WINDOW_HOURS * 60 * 60
+        seen = {
+            fingerprint: original for fingerprint, original in self.data.get(item.channel, {}).items()
+            if original["seen_at"] >= cutoff
+        }
+        for fingerprint in item.fingerprints:
+            seen.setdefault(fingerprint, {"id": item.id, "screen_name": item.screen_name, "seen_at": now})
 
+        self.data[item.channel] = seen
+        self.save_to_file()
+
+class ReplicaCoordinator:
+    """
+    Lets several replicas share the watched handles through a SQLite file on
+    a shared volume (COORDINATION_DB).
+
+    Every replica heartbeats and holds renewable leases on its fair share of
+    the handles; a replica that stops renewing for HANDLE_LEASE_SECONDS loses
+    them to the others. Deliveries are claimed with an atomic check-and-set
+    before they're sent, so a tweet fetched by two replicas around a handover
+    still only goes out once. Everything each replica has sent or errored is
+    recorded there too, including what it had sent before joining.
+
+    Calls block on SQLite's lock while another replica writes, so they're
+    made from a thread (`asyncio.to_thread`), one at a time.
+    """
+    def __init__(self, path: str, replica_id: str):
+        self.replica_id = replica_id
+        self.owned_handles: list[str] = []
+        self.leases_expire_at = 0.0
+        self.live_replicas = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Autocommit, transactions are opened explicitly with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.transaction():
+            self.db.execute("CREATE TABLE IF NOT EXISTS replicas (replica_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS leases (handle TEXT PRIMARY KEY, replica_id TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, replica_id TEXT NOT NULL, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+        print(f"Coordinating with other replicas through {path} as {replica_id}.")
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so two replicas can't both
+        # read a row as free and then both write it
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def seed_deliveries(self, keys: set[str]):
+        """
+        Record what this replica sent or errored before it was coordinating,
+        so a replica taking its handles over doesn't send them again.
+        """
+        now = time.time()
+        with self.transaction():
+            self.db.executemany(
+                "INSERT OR IGNORE INTO deliveries (key, replica_id, state, updated_at) VALUES (?, ?, 'sent', ?)",
+                [(key, self.replica_id, now) for key in keys]
+            )
+
+    def sync_leases(self, user_handles: list[str]) -> list[str]:
+        """
+        Heartbeat, renew our leases, hand back whatever is above our fair share
+        and take free or expired handles up to it.
+        """
+        now = time.time()
+        watched = {user_handle.lower(): user_handle for user_handle in user_handles}
+
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO replicas (replica_id, heartbeat_at) VALUES (?, ?) ON CONFLICT (replica_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                (self.replica_id, now)
+            )
+            self.db.execute("DELETE FROM replicas WHERE heartbeat_at < ?", (now - HANDLE_LEASE_SECONDS,))
+            self.db.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            if DEDUP_RETENTION_DAYS > 0:
+                self.db.execute("DELETE FROM deliveries WHERE state = 'sent' AND updated_at < ?", (now - DEDUP_RETENTION_DAYS * 24 * 60 * 60,))
+
+            self.live_replicas = self.db.execute("SELECT COUNT(*) FROM replicas").fetchone()[0]
+            fair_share = math.ceil(len(watched) / self.live_replicas)
+
+            leased = dict(self.db.execute("SELECT handle, replica_id FROM leases").fetchall())
+            owned = sorted(handle for handle, replica_id in leased.items() if replica_id == self.replica_id and handle in watched)
+            free = [handle for handle in sorted(watched) if handle not in leased]
+
+            for handle in owned[fair_share:]:
+                self.db.execute("DELETE FROM leases WHERE handle = ?", (handle,))
+            owned = owned[:fair_share] + free[:max(0, fair_share - len(owned))]
+
+            self.db.executemany(
+                "INSERT INTO leases (handle, replica_id, expires_at) VALUES (?, ?, ?) ON CONFLICT (handle) DO UPDATE SET expires_at = excluded.expires_at",
+                [(handle, self.replica_id, now + HANDLE_LEASE_SECONDS) for handle in owned]
+            )
+
+        self.owned_handles = [watched[handle] for handle in owned]
+        self.leases_expire_at = now + HANDLE_LEASE_SECONDS
+        return self.owned_handles
+
+    def renewal_failed(self):
+        # Stop polling our handles before the leases lapse and another replica
+        # takes them, unless the next renewal still comes in time
+        if time.time() + HANDLE_LEASE_SECONDS / 3 >= self.leases_expire_at:
+            self.owned_handles = []
+
+    def claimed_keys(self, keys: list[str]) -> set[str]:
+        """
+        Which of `keys` have gone out, or are going out from a live replica.
+        """
+        with self.lock:
+            return {key for key in keys if self._is_claimed(key)}
+
+    def _is_claimed(self, key: str) -> bool:
+        row = self.db.execute(
+            "SELECT state, heartbeat_at FROM deliveries LEFT JOIN replicas USING (replica_id) WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return False
+        state, heartbeat_at = row
+        return state == "sent" or (heartbeat_at is not None and heartbeat_at >= time.time() - HANDLE_LEASE_SECONDS)
+
+    def claim_delivery(self, key: str) -> bool:
+        """
+        Atomically take a delivery for this replica. False means it was already
+        sent, or another live replica is sending it right now.
+        """
+        with self.transaction():
+            row = self.db.execute("SELECT replica_id, state FROM deliveries WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] != self.replica_id and self._is_claimed(key):
+                return False
+            if row is not None and row[1] == "sent":
+                return False
+
+            self.db.execute(
+                "INSERT INTO deliveries (key, replica_id, state, updated_at) VALUES (?, ?, 'sending', ?) ON CONFLICT (key) DO UPDATE SET replica_id = excluded.replica_id, state = excluded.state, updated_at = excluded.updated_at",
+                (key, self.replica_id, time.time())
+            )
+            return True
+
+    def mark_sent(self, key: str):
+        # Also covers keys that were never claimed, like errored tweets and skipped duplicates
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO deliveries (key, replica_id, state, updated_at) VALUES (?, ?, 'sent', ?) ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (key, self.replica_id, time.time())
+            )
+
+    def release_delivery(self, key: str):
+        # Failed send, let whoever retries it claim it again
+        with self.lock:
+            self.db.execute("DELETE FROM deliveries WHERE key = ? AND replica_id = ? AND state = 'sending'", (key, self.replica_id))
+
+    def leave(self):
+        # Hand our handles over right away instead of waiting for the leases to expire
+        with self.transaction():
+            self.db.execute("DELETE FROM leases WHERE replica_id = ?", (self.replica_id,))
+            self.db.execute("DELETE FROM replicas WHERE replica_id = ?", (self.replica_id,))
+        with self.lock:
+            self.db.close()
+        print("Released this replica's handles.")
+
+    def print_stats(self):
+        print(f"Replica {self.replica_id}: holding {len(self.owned_handles)} handles, {self.live_replicas} live replicas.")
+
+coordinator = ReplicaCoordinator(COORDINATION_DB, REPLICA_ID) if COORDINATION_DB else None
 sent_tweets = SentTweets()
+content_fingerprints = ContentFingerprints()
+send_queue = SendQueue()
+retry_queue = RetryQueue()
+media_cache = MediaCache()
+media_prefetcher = MediaPrefetcher()
 x_auth_errors = PersistentJsonData("x_auth_status.json", {})
+user_ids = UserIdCache()
+handle_cursors = HandleCursors()
+posting_rates = PostingRates()
+timeline_cursor = PersistentJsonData("timeline_cursor.json", {})
 
-import numpy as np
 
 def generate_time_interval(low: float, high: float):
     """
@@ -274,121 +1689,360 @@ def generate_time_interval(low: float, high: float):
     scale = (high - low) / 4
 
     # Generate normally distributed value
-    interval = np.random.normal(loc=mean, scale=scale)
+    interval = random.gauss(mean, scale)
     
     # Clamp to [low, high]
-    interval = np.clip(interval, low, high)
+    interval = min(high, max(low, interval))
     
     # Get integer part and add a new random decimal
     integer_part = int(interval)
-    random_decimal = np.random.random()
+    random_decimal = random.random()
     final_interval = integer_part + random_decimal
 
     # Final clamp to ensure within range
-    return np.clip(final_interval, low, high)
+    return min(high, max(low, final_interval))
 
-def build_tweet_media(media: twikit.tweet.MEDIA_TYPE):
+def estimate_variant_bytes(variant: dict, duration_millis: int | None) -> float:
+    return (variant.get("bitrate") or 0) * (duration_millis or 0) / 8000
+
+def variant_resolution(variant: dict) -> int | None:
+    """
+    Shorter side of a variant in pixels, parsed from its `/<w>x<h>/` URL segment.
+    """
+    match = re.search(r"/(\d+)x(\d+)/", variant["url"])
+    return min(int(match.group(1)), int(match.group(2))) if match else None
+
+def select_video_variant(video_info: dict, duration_millis: int | None) -> dict:
+    """
+    Pick the highest-bitrate MP4 variant that fits within VIDEO_MAX_BYTES and
+    VIDEO_MAX_RESOLUTION, or the smallest one if none of them fit.
+    """
+    # Filter variants to only include MP4 videos
+    variants = [
+        variant for variant in video_info["variants"]
+        if variant["content_type"] == "video/mp4"
+    ]
+
+    if not variants:
+        raise Exception("Couldn't find best variant for video.")
+
+    def fits(variant):
+        if VIDEO_MAX_BYTES > 0 and estimate_variant_bytes(variant, duration_millis) > VIDEO_MAX_BYTES:
+            return False
+        resolution = variant_resolution(variant)
+        if VIDEO_MAX_RESOLUTION > 0 and resolution is not None and resolution > VIDEO_MAX_RESOLUTION:
+            return False
+        return True
+
+    bitrate = lambda variant: variant.get("bitrate") or 0
+    fitting = [variant for variant in variants if fits(variant)]
+
+    if fitting:
+        return max(fitting, key=bitrate)
+    return min(variants, key=bitrate)
+
+def build_tweet_media(media: twikit.tweet.MEDIA_TYPE) -> MediaRecord:
     """
     Process media object and return structured media data
     """
+    if isinstance(media, twikit.media.Photo):
+        return MediaRecord("photo", media.media_url,
+                           width=media.sizes["large"]["w"],
+                           height=media.sizes["large"]["h"])
+
     if isinstance(media, twikit.media.Video):
-        # Filter variants to only include MP4 videos
-        variants = [
-            variant for variant in media.video_info["variants"] 
-            if variant["content_type"] == "video/mp4"
-        ]
-        
-        # Find the variant with the highest bitrate
-        bitrates = [variant.get("bitrate", 0) for variant in variants]
-        best_bitrate = max(bitrates)
-        best_variant = next(
-            (variant for variant in variants if variant.get("bitrate") == best_bitrate), 
-            None
-        )
-        
-        if not best_variant:
-            raise Exception("Couldn't find best variant for video.")
-        
-        generator = {
-            "type": "video",
-            "poster": media.media_url,
-            "size": {
-                "height": media.sizes["large"]["h"],
-                "width": media.sizes["large"]["w"],
-            },
-            "video": {
-                "bitrate": best_variant.get("bitrate"),
-                "url": best_variant["url"],
-                "duration_millis": media.video_info.get("duration_millis"),
-            }
-        }
-        
-        return generator
-        
-    elif isinstance(media, twikit.media.Photo):
-        generator = {
-            "type": "photo",
-            "url": media.media_url,
-            "size": {
-                "height": media.sizes["large"]["h"],
-                "width": media.sizes["large"]["w"],
-            }
-        }
-        return generator
-        
+        duration_millis = media.video_info.get("duration_millis")
+        media_type = "video"
     else:  # animated_gif
-        return {
-            "type": "animated_gif",
-            "poster": media.media_url,
-            "size": {
-                "height": media.sizes["large"]["h"],
-                "width": media.sizes["large"]["w"],
-            },
-            "video": {
-                "bitrate": media.video_info["variants"][0].get("bitrate"),
-                "url": media.video_info["variants"][0]["url"],
-                "duration_millis": 6000,
-            }
-        }
+        duration_millis = 6000
+        media_type = "animated_gif"
+
+    best_variant = select_video_variant(media.video_info, duration_millis)
+
+    return MediaRecord(media_type, best_variant["url"], media.media_url,
+                       width=media.sizes["large"]["w"],
+                       height=media.sizes["large"]["h"],
+                       bitrate=best_variant.get("bitrate"),
+                       duration_millis=duration_millis)
 
-def build_tweet_text(tweet: Tweet) -> str:
-    tweet_url = f"https://x.com/{tweet.user.screen_name}/status/{tweet.id}"
+def parse_tweet_time(created_at: str) -> datetime.datetime:
+    return datetime.datetime.strptime(created_at, "%a %b %d %H:%M:%S %z %Y")
 
-    tweet_text: str = tweet.full_text
-    if tweet.media:
-        for media in tweet.media:
-            tweet_text = tweet_text.replace(media.url, "")
+def build_tweet_text(tweet: TweetRecord) -> str:
+    tweet_url = f"https://x.com/{tweet.screen_name}/status/{tweet.id}"
 
-    tweet_text = tweet_text.strip()
+    tweet_text = tweet.text.strip()
     tweet_text += "\n\n" + tweet_url
 
-    time = datetime.datetime.strptime(tweet.created_at, "%a %b %d %H:%M:%S %z %Y")
+    time = parse_tweet_time(tweet.created_at)
     tweet_text += "\n\n" + time.strftime("%I:%M%p %Z, %B %d")
 
-    return f"_*@{tweet.user.screen_name} {'✓' if tweet.user.is_blue_verified else ''}:*_\n\n" + tweet_text
+    return f"_*@{tweet.screen_name} {'✓' if tweet.is_blue_verified else ''}:*_\n\n" + tweet_text
+
+def normalize_tweet_text(text: str) -> str:
+    text = re.sub(r"^RT @\w+:\s*", "", text)
+    text = re.sub(r"https?://\S+", "", text)
+    text = re.sub(r"[^\w\s]", "", text.lower())
+    return " ".join(text.split())
+
+def content_fingerprints_of(tweet: TweetRecord) -> list[str]:
+    """
+    Keys a tweet's content is matched on: its normalized text (retweet prefix,
+    links, punctuation, case and spacing ignored) and each of its media.
+    """
+    fingerprints = []
+
+    text = normalize_tweet_text(tweet.text)
+    if len(text) >= CONTENT_DEDUP_MIN_TEXT_LENGTH:
+        fingerprints.append("text:" + hashlib.sha1(text.encode()).hexdigest())
+
+    for media in tweet.media:
+        # A video's poster is stable, the variant URL depends on VIDEO_MAX_* caps
+        fingerprints.append("media:" + (media.poster or media.url))
+
+    return fingerprints
+
+def collapse_duplicate(item: DeliveryItem, original: dict) -> DeliveryItem:
+    tweet_url = f"https://x.com/{item.screen_name}/status/{item.id}"
+    text = f"_*@{item.screen_name}* also posted this (sent earlier from @{original['screen_name']})._\n\n{tweet_url}"
+    return item.replace(text=text, media=())
+
+def channels_for(user_handle: str) -> list[str]:
+    return CHANNEL_ROUTES.get(user_handle.lower()) or CHANNEL_ROUTES.get("*") or [CHANNEL_ID]
+
+def build_queue_items(tweet: TweetRecord, channels: list[str]) -> list[DeliveryItem]:
+    """
+    Everything the delivery workers need to send a tweet to each channel. The
+    message is built once and shared by every channel.
+    """
+    if tweet.media_error:
+        raise ValueError(f"Couldn't read the tweet's media: {tweet.media_error}")
+
+    text = build_tweet_text(tweet)
+    fingerprints = tuple(content_fingerprints_of(tweet))
+    enqueued_at = time.time()
+
+    return [
+        DeliveryItem(tweet.id, tweet.screen_name, tweet.created_at, channel, text, tweet.media, enqueued_at,
+                     fingerprints=fingerprints)
+        for channel in channels
+    ]
+
+async def delivery_worker():
+    while True:
+        item = await send_queue.get()
+
+        # Sends stay in order, but the downloads for the next few in line, and
+        # for this tweet's later videos, run in the background meanwhile. Its
+        # first video streams straight through
+        media_prefetcher.hold(item)
+        for sibling_item in send_queue.siblings(item):
+            media_prefetcher.prefetch(sibling_item)
+        for upcoming_item in send_queue.upcoming(PREFETCH_AHEAD):
+            media_prefetcher.prefetch(upcoming_item)
+
+        try:
+            print(f"\n------ SENDING TWEET {item.id} BY @{item.screen_name} TO {item.channel} ------")
+            await sent_tweets.deliver(item)
+        finally:
+            media_prefetcher.discard(item)
+
+        # Only once it's sent, errored or handed to the retry queue; cancelled
+        # mid-send it stays in send_queue.json for the next start
+        await send_queue.done(item)
+        send_queue.print_stats()
+
+async def retry_worker():
+    while True:
+        for item in retry_queue.due():
+            # Retries are the low-priority lane, they only go out while the
+            # channel has no fresh tweets waiting
+            if not await send_queue.claim_idle_channel(item.channel):
+                continue
+
+            try:
+                print(f"\n------ RETRYING TWEET {item.id} BY @{item.screen_name} TO {item.channel} ------")
+                await sent_tweets.deliver(item)
+            finally:
+                await send_queue.release_channel(item.channel)
+
+            # Cancelled mid-send, it stays in retry_queue.json for the next start
+            retry_queue.remove(item)
+
+        await asyncio.sleep(RETRY_CHECK_SECONDS)
+
+def create_x_client() -> Client:
+    return Client('en-US',
+        user_agent=os.getenv("X_USER_AGENT", "Mozilla/5.0 (Linux; Android 16; SM-N960U) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.7151.90 Mobile Safari/537.36"),
+        proxy=WARP_PROXY_URL
+    )
+
+def hash_ring_position(value: str) -> int:
+    return int(hashlib.md5(value.encode()).hexdigest(), 16)
+
+class XAccount:
+    """
+    One X client with its own request bucket, taken out of rotation while
+    it's rate limited or for good once X rejects its credentials.
+    """
+    def __init__(self, name: str, client: Client):
+        self.name = name
+        self.client = client
+        self.requests = TokenBucket(f"X requests ({name})", X_MAX_REQUESTS_PER_MINUTE, 1)
+        self.disabled_reason: str | None = None
+        self.fetches = 0
+        self.errors = 0
+
+    def is_usable(self) -> bool:
+        return self.disabled_reason is None
+
+    def is_available(self) -> bool:
+        return self.is_usable() and self.requests.paused_until <= time.time()
+
+    def rate_limited(self, e: twikit.errors.TooManyRequests):
+        self.errors += 1
+        reset_at = e.rate_limit_reset or time.time() + X_RATE_LIMIT_FALLBACK_SECONDS
+        # A few seconds past the reset so we don't land right on the boundary
+        self.requests.pause_until(reset_at + generate_time_interval(2, 10))
+        print(f"X rate limit hit on {self.name}, resting it for {round(reset_at - time.time())}s until it resets.")
+
+    def disable(self, e: twikit.errors.TwitterException):
+        self.errors += 1
+        self.disabled_reason = f"{type(e).__name__}: {e}"
+        print(f"X account {self.name} taken out of rotation: {self.disabled_reason}")
+
+    def status(self) -> str:
+        if not self.is_usable():
+            return "disabled"
+        return "available" if self.is_available() else "rate limited"
+
+    def print_health(self):
+        stats = self.requests.stats()
+        paused = f", resting for {stats['paused_for_seconds']}s" if stats["paused_for_seconds"] else ""
+        reason = f" ({self.disabled_reason})" if self.disabled_reason else ""
+        print(f"X account {self.name}: {self.status()}{reason}, {self.fetches} fetches, {self.errors} errors, {stats['used']} requests{paused}.")
+
+class XClientPool:
+    """
+    Every X account available to us. Handles are spread over the accounts
+    that are in rotation by consistent hashing, so an account dropping out
+    (or coming back) only moves the handles that hashed to it.
+    """
+    def __init__(self, accounts: list[XAccount]):
+        self.accounts = accounts
+        self.ring = sorted(
+            ((hash_ring_position(f"{account.name}#{replica}"), account) for account in accounts for replica in range(100)),
+            key=lambda entry: entry[0]
+        )
+
+    @property
+    def primary(self) -> XAccount:
+        return self.accounts[0]
+
+    def account_for(self, user_handle: str) -> XAccount:
+        usable = [account for account in self.accounts if account.is_usable()]
+        if not usable:
+            raise twikit.errors.Unauthorized("Every X account has been taken out of rotation.")
+
+        if not any(account.is_available() for account in usable):
+            # Everyone is resting, wait on whoever's limit resets first
+            return min(usable, key=lambda account: account.requests.paused_until)
+
+        start = bisect.bisect(self.ring, hash_ring_position(user_handle.lower()), key=lambda entry: entry[0])
+        for i in range(len(self.ring)):
+            account = self.ring[(start + i) % len(self.ring)][1]
+            if account.is_available():
+                return account
+
+    def handle_error(self, account: XAccount, e: twikit.errors.TwitterException):
+        """
+        Rest or drop the account that hit `e`. Anything that isn't a rate limit
+        or a bad account, or that hits the last usable account, is recorded as
+        an auth error and re-raised like before.
+        """
+        metrics.inc("tweetky_x_errors_total", account=account.name, error=type(e).__name__)
+        if isinstance(e, twikit.errors.TooManyRequests):
+            account.rate_limited(e)
+            return
+
+        other_accounts = [other for other in self.accounts if other is not account and other.is_usable()]
+        if isinstance(e, X_ACCOUNT_ERRORS) and other_accounts:
+            account.disable(e)
+            return
+
+        save_x_auth_error(e)
+        raise e
+
+    def print_health(self):
+        for account in self.accounts:
+            account.print_health()
 
-client = Client('en-US',
-    user_agent=os.getenv("X_USER_AGENT", "Mozilla/5.0 (Linux; Android 16; SM-N960U) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.7151.90 Mobile Safari/537.36"),
-    proxy=WARP_PROXY_URL
+X_ACCOUNT_ERRORS = (
+    twikit.errors.Unauthorized,
+    twikit.errors.Forbidden,
+    twikit.errors.AccountSuspended,
+    twikit.errors.AccountLocked,
 )
 
+client = create_x_client()
+x_accounts = XClientPool([XAccount("account1", client)] + [
+    XAccount(f"account{i + 2}", create_x_client()) for i in range(len(X_COOKIES_POOL[1:]))
+])
+
+async def fetch_verification_code(api_key: str, since: datetime.datetime) -> str | None:
+    """
+    Poll ImprovMX's logs for X's confirmation code email, backing off between
+    polls, for up to X_VERIFICATION_TIMEOUT_SECONDS.
+    """
+    print("Fetching verification code from ImprovMX logs...")
+    delay = VERIFICATION_POLL_BASE_SECONDS
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session, \
+                asyncio.timeout(X_VERIFICATION_TIMEOUT_SECONDS):
+            while True:
+                async with session.get("https://api.improvmx.com/v3/domains/obaid.xyz/logs", headers={
+                    "Authorization": f"Basic api:{api_key}"
+                }) as response:
+                    logs = await response.json()
+
+                matching_logs = [log for log in logs['logs'] if log['created'] > since and 'Your X confirmation code is' in log['subject']]
+                if matching_logs:
+                    break
+
+                print(f"No verification code email found, checking again in {delay}s...")
+                await asyncio.sleep(delay)
+                delay = min(VERIFICATION_POLL_MAX_SECONDS, delay * 2)
+    except TimeoutError:
+        raise twikit.errors.Unauthorized(f"No verification code email arrived within {X_VERIFICATION_TIMEOUT_SECONDS}s.")
+
+    match = re.search(r'(?<=Your X confirmation code is )[a-z0-9]+', matching_logs[0]["subject"])
+    return match.group() if match else None
+
 @contextmanager
-def intercept_twitter_flows():
-    _print = builtins.print
-    _input = builtins.input
+def intercept_twitter_flows(main_loop: asyncio.AbstractEventLoop):
+    """
+    Answer the prompts twikit's login flow print()s and input()s, by
+    shadowing print/input in twikit's client module (and nowhere else) for
+    as long as the login runs.
 
+    Meant for the login thread (see `login_client`): input() has to answer
+    synchronously, so the wait for a verification code runs on `main_loop`
+    and only the login thread blocks on it.
+    """
+    twikit_client_module = twikit.client.client
     time_of_call = datetime.datetime.now()
-    
-    printed_text = ""
+
+    # Lines printed since the last prompt
+    printed_lines: list[str] = []
     
     def intercepted_print(*args, **kwargs):
-        nonlocal printed_text
-        printed_text += " ".join(str(arg) for arg in args) + "\n"
-        _print(*args, **kwargs)
+        printed_lines.append(" ".join(str(arg) for arg in args))
+        print(*args, **kwargs)
     
     def intercepted_input(prompt=""):
-        nonlocal printed_text
-        printed_text += prompt
+        printed_lines.append(prompt)
+        printed_text = "\n".join(printed_lines)
+        printed_lines.clear()
 
         if "Verify your identity by entering the email address" in printed_text:
             print(printed_text)
@@ -401,19 +2055,9 @@ def intercept_twitter_flows():
         elif "code sent":
             IMPROV_MX_API_KEY = os.getenv("IMPROVMX_APIKEY", None)
             if IMPROV_MX_API_KEY is not None:
-                print("Fetching verification code from ImprovMX logs...")
-                matching_logs = []
-                while len(matching_logs) == 0:
-                    response = requests.get("https://api.improvmx.com/v3/domains/obaid.xyz/logs", headers={
-                        "Authorization": f"Basic api:{IMPROV_MX_API_KEY}"
-                    })
-                    logs = response.json()
-                    matching_logs = [log for log in logs['logs'] if log['created'] > time_of_call and 'Your X confirmation code is' in log['subject']]
-                    print("No verification code email found...")
-                    time.sleep(2)
-                
-                match = re.search(r'(?<=Your X confirmation code is )[a-z0-9]+', matching_logs[0]["subject"])
-                verification_code = match.group() if match else None
+                verification_code = asyncio.run_coroutine_threadsafe(
+                    fetch_verification_code(IMPROV_MX_API_KEY, time_of_call), main_loop
+                ).result()
 
                 sleep_time = round(generate_time_interval(2, 6), 2)
                 print(f"Naturally sleeping for {sleep_time}...")
@@ -425,16 +2069,16 @@ def intercept_twitter_flows():
                 raise twikit.errors.Unauthorized("Code requested... no API key provided to pull from ImprovMX automatically.")
         else:
             print("Unknown input requested...")
-            _input(prompt)
+            return input(prompt)
     
-    builtins.print = _print
-    builtins.input = _input
+    twikit_client_module.print = intercepted_print
+    twikit_client_module.input = intercepted_input
     
     try:
         yield
     finally:
-        builtins.print = intercepted_print
-        builtins.input = intercepted_input
+        del twikit_client_module.print
+        del twikit_client_module.input
 
 async def login_client():
     print("Logging in to X...", dict(
@@ -443,20 +2087,49 @@ async def login_client():
         X_PASSWORD=X_PASSWORD,
         X_USER_AGENT=os.getenv("X_USER_AGENT")
     ))
-    with intercept_twitter_flows():
-        await client.login(
-            auth_info_1=X_USERNAME ,
-            auth_info_2=X_EMAIL,
-            password=X_PASSWORD,
-        )
+    main_loop = asyncio.get_running_loop()
+    login_x_client = create_x_client()
+
+    async def log_in():
+        try:
+            await login_x_client.login(
+                auth_info_1=X_USERNAME ,
+                auth_info_2=X_EMAIL,
+                password=X_PASSWORD,
+            )
+        finally:
+            await login_x_client.http.aclose()
+
+    def run_login_flow():
+        with intercept_twitter_flows(main_loop):
+            asyncio.run(log_in())
+
+    # twikit's login answers its prompts with a blocking input(), so the whole
+    # flow runs on its own thread and loop with a throwaway client, and only
+    # the resulting cookies are carried over
+    await asyncio.to_thread(run_login_flow)
+    client.set_cookies(login_x_client.get_cookies())
 
     client.save_cookies(DATA_DIR + 'cookies.json')
 
+def save_x_auth_error(e: twikit.errors.TwitterException):
+    x_auth_errors._overwrite_and_save({
+        "error": True,
+        "message": str(e),
+        "args": e.args,
+        "X_COOKIES": X_COOKIES,
+        "X_USERNAME": X_USERNAME,
+        "X_EMAIL": X_EMAIL,
+        "X_PASSWORD": X_PASSWORD,
+        "X_FORCE_PUSH_AUTH": X_FORCE_PUSH_AUTH
+    })
+
 async def attempt_cached_login():
     if X_COOKIES is not None:
-        cookies = json.loads(base64.b64decode(os.getenv("X_COOKIES", "{}")).decode())
-        client.set_cookies(cookies)
-        print("Successfully loaded cookies from environment variable.")
+        for account, encoded_cookies in zip(x_accounts.accounts, X_COOKIES_POOL):
+            cookies = json.loads(base64.b64decode(encoded_cookies).decode())
+            account.client.set_cookies(cookies)
+        print(f"Successfully loaded cookies for {len(X_COOKIES_POOL)} account(s) from environment variable.")
     else:
         try:
             with open(DATA_DIR + 'cookies.json', 'r') as f:
@@ -469,16 +2142,7 @@ async def attempt_cached_login():
                 await login_client()
                 print("Successfully logged in and saved cookies.")
             except twikit.TwitterException as e:
-                x_auth_errors._overwrite_and_save({
-                    "error": True,
-                    "message": str(e),
-                    "args": e.args,
-                    "X_COOKIES": X_COOKIES,
-                    "X_USERNAME": X_USERNAME,
-                    "X_EMAIL": X_EMAIL,
-                    "X_PASSWORD": X_PASSWORD,
-                    "X_FORCE_PUSH_AUTH": X_FORCE_PUSH_AUTH
-                })
+                save_x_auth_error(e)
                 raise e
 
 def pull_straw(probability: float) -> bool:
@@ -487,7 +2151,268 @@ def pull_straw(probability: float) -> bool:
     
     return random.random() < probability
 
+class FetchScheduler:
+    """
+    Lets handles be fetched concurrently while capping how many are in flight
+    (X_FETCH_CONCURRENCY). Every X request goes through its account's
+    bucket plus a random extra delay so timings don't look scripted.
+    """
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def throttle(self, account: XAccount):
+        await account.requests.acquire()
+
+        interval = 60 / X_MAX_REQUESTS_PER_MINUTE
+        await asyncio.sleep(generate_time_interval(0, interval * 0.5))
+
+async def resolve_user_id(user_handle: str, account: XAccount, scheduler: FetchScheduler) -> str:
+    user_id = user_ids.get(user_handle)
+    if user_id is None:
+        await scheduler.throttle(account)
+        user = await account.client.get_user_by_screen_name(user_handle)
+        user_id = user_ids.put(user_handle, user)
+    return user_id
+
+async def fetch_user_tweets(user_handle: str, account: XAccount, scheduler: FetchScheduler) -> list[TweetRecord]:
+    """
+    Fetch a handle's tweets newest first, paging back until its high-water
+    mark is reached or HANDLE_MAX_PAGES run out.
+    """
+    user_id = await resolve_user_id(user_handle, account, scheduler)
+    newest_seen_id = handle_cursors.newest_id(user_handle)
+
+    async def fetch_page(count: int, cursor: str | None = None):
+        await scheduler.throttle(account)
+        started_at = time.monotonic()
+        try:
+            return await account.client.get_user_tweets(user_id, "Tweets", count=count, cursor=cursor)
+        finally:
+            metrics.observe("tweetky_x_request_seconds", time.monotonic() - started_at, handle=user_handle)
+
+    try:
+        page = await fetch_page(handle_cursors.page_size(user_handle))
+    except twikit.errors.NotFound:
+        # The cached ID may be stale (account deleted and handle re-registered),
+        # resolve the handle again once before giving up.
+        print(f"User ID for {user_handle} not found, refreshing cache...")
+        user_ids.invalidate(user_handle)
+        user_id = await resolve_user_id(user_handle, account, scheduler)
+        page = await fetch_page(handle_cursors.page_size(user_handle))
+
+    tweets = list(map(TweetRecord.from_tweet, page))
+
+    # Without a mark there's nothing to catch up to, the first page is enough
+    if newest_seen_id is not None:
+        pages = 1
+        while len(page) > 0 and pages < HANDLE_MAX_PAGES and all(int(tweet.id) > newest_seen_id for tweet in page):
+            print(f"{user_handle} posted a full page since the last sweep, fetching more...")
+            page = await fetch_page(HANDLE_PAGE_SIZE_MAX, page.next_cursor)
+            tweets.extend(map(TweetRecord.from_tweet, page))
+            pages += 1
+
+    return tweets
+
+async def queue_new_tweets(user_handle: str, tweets: list[TweetRecord]):
+    """
+    Queue whichever of a handle's tweets (oldest first) haven't been seen yet.
+    """
+    posting_rates.observe(user_handle, tweets)
+
+    channels = channels_for(user_handle)
+    claimed = set()
+    if coordinator:
+        keys = [delivery_key(tweet.id, channel) for tweet in tweets for channel in channels]
+        claimed = await asyncio.to_thread(coordinator.claimed_keys, keys)
+
+    def is_pending(tweet: TweetRecord, channel: str) -> bool:
+        key = delivery_key(tweet.id, channel)
+        return not (
+            sent_tweets.exists(key)
+            or sent_tweets.errored.exists(key)
+            or send_queue.contains(key)
+            or retry_queue.contains(key)
+            or key in claimed
+        )
+
+    new_tweets = [
+        (tweet, [channel for channel in channels if is_pending(tweet, channel)])
+        for tweet in tweets
+    ]
+    new_tweets = [(tweet, pending_channels) for tweet, pending_channels in new_tweets if pending_channels]
+
+    print("New tweets to process:", len(new_tweets))
+
+    for i, (tweet, pending_channels) in enumerate(new_tweets):
+        print(f"\n{i+1}. ------ QUEUING NEW TWEET ------")
+        try:
+            for item in build_queue_items(tweet, pending_channels):
+                await send_queue.put(item)
+        except Exception as e:
+            for channel in pending_channels:
+                await sent_tweets.errored.add(delivery_key(tweet.id, channel))
+
+            print("Failed to build message for tweet.", e)
+            traceback.print_exc()
+
+    # Only move the mark once the tweets behind it are safely queued
+    handle_cursors.update(user_handle, tweets)
+
+async def fetch_and_queue_handle(user_handle: str, scheduler: FetchScheduler):
+    account = x_accounts.account_for(user_handle)
+    try:
+        async with scheduler.semaphore:
+            tweets = list(reversed(await fetch_user_tweets(user_handle, account, scheduler)))
+        account.fetches += 1
+        metrics.inc("tweetky_x_fetches_total", handle=user_handle, result="ok")
+
+        print("Fetched tweets for user:", user_handle, "via", account.name, "Total:", len(tweets))
+
+        await queue_new_tweets(user_handle, tweets)
+    except twikit.errors.TwitterException as e:
+        rate_limited = isinstance(e, twikit.errors.TooManyRequests)
+        metrics.inc("tweetky_x_fetches_total", handle=user_handle, result="rate_limited" if rate_limited else "error")
+        # Rate limits and bad accounts only rest/drop that account, the handle
+        # moves to another one and is picked up again on its next poll
+        x_accounts.handle_error(account, e)
+    except Exception as e:
+        metrics.inc("tweetky_x_fetches_total", handle=user_handle, result="error")
+        print(f"Non-twikit error thrown while fetching tweets for user {user_handle}: {e}")
+        traceback.print_exc()
+
+async def poll_due_handles(user_handles: list[str], scheduler: FetchScheduler, polling: PollingSchedule):
+    """
+    One round in the default mode: fetch every handle whose poll is due.
+    """
+    due_handles = polling.due_handles(user_handles)
+
+    # Keep cover traffic proportional to the handles actually polled this round
+    straw_probability = 0.3 * len(due_handles) / len(user_handles)
+    if due_handles:
+        account = x_accounts.account_for(random.choice(due_handles))
+        fetch_timeline_function = lambda: account.client.get_timeline(count=20)
+
+    while pull_straw(straw_probability):
+        print(f"Straw pulled true, fetching home timeline for {account.name}...")
+        await scheduler.throttle(account)
+        try:
+            results = await fetch_timeline_function()
+
+            print(f"Fetched {len(results)} tweets...")
+
+            fetch_timeline_function = results.next
+        except twikit.errors.TwitterException as e:
+            x_accounts.handle_error(account, e)
+            break
+        straw_probability = 0.3
+
+    async with asyncio.TaskGroup() as task_group:
+        for user_handle in due_handles:
+            task_group.create_task(fetch_and_queue_handle(user_handle, scheduler))
+
+    for user_handle in due_handles:
+        polling.schedule(user_handle)
+
+async def fetch_latest_timeline(account: XAccount, scheduler: FetchScheduler) -> tuple[list[TweetRecord], bool]:
+    """
+    Newest-first tweets from Home -> Following, paged back to the last-seen
+    ID. Also returns whether that ID was reached; if it wasn't, tweets in
+    between may have been missed.
+    """
+    newest_seen_id = timeline_cursor.data.get("newest_id")
+
+    await scheduler.throttle(account)
+    page = await account.client.get_latest_timeline(count=TIMELINE_PAGE_SIZE)
+    tweets = list(map(TweetRecord.from_tweet, page))
+
+    if newest_seen_id is None:
+        return tweets, False
+
+    pages = 1
+    while len(page) > 0 and all(int(tweet.id) > int(newest_seen_id) for tweet in page):
+        if pages >= HANDLE_MAX_PAGES:
+            return tweets, False
+
+        await scheduler.throttle(account)
+        page = await page.next()
+        tweets.extend(map(TweetRecord.from_tweet, page))
+        pages += 1
+
+    return tweets, True
+
+async def poll_home_timeline(user_handles: list[str], scheduler: FetchScheduler):
+    """
+    One round in X_TIMELINE_MODE: read every watched handle's new tweets off
+    the home timeline, and only fetch handles one by one when there may be a
+    gap (first run, or more new tweets than HANDLE_MAX_PAGES pages).
+    """
+    watched_handles = {user_handle.lower(): user_handle for user_handle in user_handles}
+
+    # Only the first account is expected to follow the watched handles
+    account = x_accounts.primary
+    if not account.is_available():
+        print(f"{account.name} can't read the home timeline right now, fetching every watched handle directly...")
+        tweets, reached_last_seen = [], False
+    else:
+        try:
+            tweets, reached_last_seen = await fetch_latest_timeline(account, scheduler)
+            account.fetches += 1
+        except twikit.errors.TwitterException as e:
+            x_accounts.handle_error(account, e)
+            return
+
+    tweets_by_handle = {user_handle: [] for user_handle in user_handles}
+    for tweet in tweets:
+        user_handle = watched_handles.get(tweet.screen_name.lower())
+        if user_handle is not None:
+            tweets_by_handle[user_handle].append(tweet)
+
+    print(f"Fetched {len(tweets)} home timeline tweets, {sum(map(len, tweets_by_handle.values()))} from watched handles.")
+
+    for user_handle, handle_tweets in tweets_by_handle.items():
+        if handle_tweets:
+            print("Timeline tweets for user:", user_handle, "Total:", len(handle_tweets))
+            await queue_new_tweets(user_handle, list(reversed(handle_tweets)))
+
+    if tweets:
+        timeline_cursor._overwrite_and_save({"newest_id": str(max(int(tweet.id) for tweet in tweets))})
+
+    if not reached_last_seen:
+        print("Home timeline may have a gap, fetching every watched handle directly...")
+        async with asyncio.TaskGroup() as task_group:
+            for user_handle in user_handles:
+                task_group.create_task(fetch_and_queue_handle(user_handle, scheduler))
+
+async def lease_worker(user_handles: list[str]):
+    while True:
+        await asyncio.sleep(HANDLE_LEASE_SECONDS / 3)
+        try:
+            await asyncio.to_thread(coordinator.sync_leases, user_handles)
+        except sqlite3.Error as e:
+            print("Failed to renew handle leases, retrying.", e)
+            coordinator.renewal_failed()
+
+async def bootstrap():
+    """
+    Wait for the WARP proxy and the WhatsApp gateway at the same time (for at
+    most STARTUP_TIMEOUT_SECONDS), reading the sent/errored state off disk
+    meanwhile.
+    """
+    try:
+        async with asyncio.timeout(STARTUP_TIMEOUT_SECONDS):
+            await asyncio.gather(
+                print_public_ip(),
+                wait_for_warp_proxy(),
+                verify_whatsapp_login(),
+                asyncio.to_thread(sent_tweets.load),
+            )
+    except TimeoutError:
+        raise Exception(f"WARP proxy or WhatsApp API still not ready after {STARTUP_TIMEOUT_SECONDS}s.")
+
 async def main():
+    metrics_server = await start_metrics_server()
+    await bootstrap()
+
     if x_auth_errors.data.get("error"):
         if X_COOKIES and X_COOKIES == x_auth_errors.data.get("X_COOKIES"):
             raise Exception('X threw an error last time it was run, remove or change X_COOKIES and restart service.')
@@ -507,82 +2432,62 @@ async def main():
             x_auth_errors.save_to_file()
     
     await attempt_cached_login()
+    metrics.ready = True
 
     user_handles = [handle for handle in os.getenv("X_HANDLES_TO_WATCH", "DropSiteNews").split(",") if handle.strip()]
+    scheduler = FetchScheduler(X_FETCH_CONCURRENCY)
+    polling = PollingSchedule(user_handles)
+
+    workers = [asyncio.create_task(delivery_worker()) for _ in range(SEND_WORKERS)]
+    workers.append(asyncio.create_task(retry_worker()))
+    if coordinator:
+        await asyncio.to_thread(coordinator.seed_deliveries, sent_tweets.data | sent_tweets.errored.data)
+        await asyncio.to_thread(coordinator.sync_leases, user_handles)
+        workers.append(asyncio.create_task(lease_worker(user_handles)))
 
     try:
         while True:
-            fetch_timeline_function = lambda: client.get_timeline(count=20)
-
-            while pull_straw(0.3):
-                print("Straw pulled true, fetching home timeline...")
-                with intercept_twitter_flows():
-                    results = await fetch_timeline_function()
-                    
-                    print(f"Fetched {len(results)} tweets...")
-                    
-                    fetch_timeline_function = results.next
-
-            all_users_new_tweets = []
-            for user_handle in user_handles:
-                try:
-                    with intercept_twitter_flows():
-                        user = await client.get_user_by_screen_name(user_handle)
-
-                    with intercept_twitter_flows():
-                        tweets = list(reversed(await user.get_tweets("Tweets", count=40)))
-
-                    print("Fetched tweets for user:", user.screen_name, "Total:", len(tweets))
-
-                    new_tweets = [tweet for tweet in tweets if not sent_tweets.exists(tweet) and not sent_tweets.errored.exists(tweet)]
-
-                    print("New tweets to process:", len(new_tweets))
-                    all_users_new_tweets.extend(new_tweets)
-
-                    for i, tweet in enumerate(tweets):
-                        if sent_tweets.exists(tweet) or sent_tweets.errored.exists(tweet):
-                            continue
-                        
-                        print(f"\n{i+1}. ------ QUEUING NEW TWEET ------")
-                        await sent_tweets.add(tweet)
-
-                    sleep_time = round(generate_time_interval(3, 19), 2)
-                    print(f"Sleeping for {sleep_time} seconds to avoid rate limiting...")
-                    await asyncio.sleep(sleep_time) # Sleep to avoid rate limiting
-                except twikit.errors.Unauthorized as e:
-                    x_auth_errors._overwrite_and_save({
-                        "error": True,
-                        "message": str(e),
-                        "args": e.args,
-                        "X_COOKIES": X_COOKIES,
-                        "X_USERNAME": X_USERNAME,
-                        "X_EMAIL": X_EMAIL,
-                        "X_PASSWORD": X_PASSWORD,
-                        "X_FORCE_PUSH_AUTH": X_FORCE_PUSH_AUTH
-                    })
-                    raise e
-                except twikit.errors.TwitterException as e:
-                    x_auth_errors._overwrite_and_save({
-                        "error": True,
-                        "message": str(e),
-                        "args": e.args,
-                        "X_COOKIES": X_COOKIES,
-                        "X_USERNAME": X_USERNAME,
-                        "X_EMAIL": X_EMAIL,
-                        "X_PASSWORD": X_PASSWORD,
-                        "X_FORCE_PUSH_AUTH": X_FORCE_PUSH_AUTH
-                    })
-                    raise e
-                except Exception as e:
-                    print(f"Non-twikit error thrown while fetching tweets for user {user_handle}: {e}")
-                    traceback.print_exc()
-                    continue
+            # With replicas, only the handles leased to this one are polled here
+            owned_handles = coordinator.owned_handles if coordinator else user_handles
+
+            if not owned_handles:
+                print("No handles are leased to this replica right now.")
+                sleep_time, next_poll = HANDLE_LEASE_SECONDS / 3, "the next lease check"
+            elif X_TIMELINE_MODE:
+                await poll_home_timeline(owned_handles, scheduler)
+                sleep_time, next_poll = polling.seconds_until_timeline_poll(), "the home timeline"
+            else:
+                await poll_due_handles(owned_handles, scheduler, polling)
+                sleep_time, next_handle = polling.seconds_until_next_poll(owned_handles)
+                next_poll = f"@{next_handle}"
 
-            sleep_time = round(generate_time_interval(4 * 60, 40 * 60), 2)
-            
-            print(f"\n\nSleeping for {round(sleep_time / 60, 2)} minutes before checking for new tweets again...")
+            if coordinator:
+                # Wake up in time to pick up handles handed over by other replicas
+                sleep_time = min(sleep_time, HANDLE_LEASE_SECONDS / 3)
+                coordinator.print_stats()
+
+            metrics.last_round_at = time.time()
+
+            print(f"User ID cache: {user_ids.hits} hits, {user_ids.misses} misses so far.")
+            send_queue.print_stats()
+            retry_queue.print_stats()
+            media_cache.print_stats()
+            x_accounts.print_health()
+            whatsapp_sends.print_stats()
+
+            print(f"\n\nSleeping for {round(sleep_time / 60, 2)} minutes until {next_poll} is due again...")
             await asyncio.sleep(sleep_time)
     except KeyboardInterrupt:
         print("KeyboardInterrupt received, exiting...")
-
-asyncio.run(main())
+    finally:
+        for worker in workers:
+            worker.cancel()
+        if coordinator:
+            await asyncio.to_thread(coordinator.leave)
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await whatsapp.close()
+        await cdn.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())